@@ -1,16 +1,33 @@
 import os
 import json
+import math
+import base64
 import time
 import asyncio
 import logging
+import copy
+import itertools
+import hashlib
+import lzma
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right, insort
 from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from zoneinfo import ZoneInfo
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 import yt_dlp
+from yt_dlp.extractor import gen_extractor_classes, get_info_extractor
+from yt_dlp.utils import DownloadError, GeoRestrictedError, UnsupportedError, variadic
+import re
 import glob
 import shutil
-from flask import Flask
-from threading import Thread
+from flask import Flask, Response
+from threading import Lock, Thread
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,8 +40,24 @@ print(ADMIN_USER_IDS, type(ADMIN_USER_IDS[0]))
 
 # Data files
 USERS_DATA_FILE = "users_data.json"
-VIDEOS_DATA_FILE = "videos_data.json"
+VIDEOS_DATA_FILE = "videos_data.json"  # Legacy, imported into DOWNLOAD_LOG_FILE
+DOWNLOAD_LOG_FILE = "download_log.jsonl"
 BOT_DATA_FILE = "bot_data.json"
+BOT_DATA_WAL_FILE = "bot_data.wal"
+EXTRACTOR_INDEX_FILE = "extractor_index.json"
+DAILY_STATS_FILE = "daily_stats.json"
+POPULAR_VIDEOS_FILE = "popular_videos.json"
+ACTIVE_USERS_FILE = "active_users.json"
+ADMIN_STATS_FILE = "admin_stats.json"
+
+# last_seen only moves when it is at least this many seconds stale, and
+# changed profiles are written in batches every USER_FLUSH_INTERVAL seconds
+LAST_SEEN_GRANULARITY = int(os.getenv("LAST_SEEN_GRANULARITY", "60"))
+USER_FLUSH_INTERVAL = int(os.getenv("USER_FLUSH_INTERVAL", "30"))
+
+# Daily stats roll over at RESET_HOUR:00 in RESET_TIMEZONE
+RESET_TIMEZONE = ZoneInfo(os.getenv("RESET_TIMEZONE", "UTC"))
+RESET_HOUR = int(os.getenv("RESET_HOUR", "0"))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -68,23 +101,734 @@ def load_json_data(filename, default_data=None):
         return default_data
 
 
-def save_json_data(filename, data):
-    """Save data to JSON file"""
+def save_json_data(filename, data, durable=False):
+    """Save data to JSON file
+
+    Written to a temp file and swapped in, so readers (and snapshots) only
+    ever see a complete file. durable also fsyncs it before the swap.
+    """
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
+        temp_path = f"{filename}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False, default=str)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, filename)
         return True
     except Exception as e:
         logger.error(f"Error saving {filename}: {e}")
         return False
 
 
+def fsync_quietly(file):
+    """fsync that tolerates the file having been closed in the meantime"""
+    try:
+        os.fsync(file.fileno())
+    except (OSError, ValueError):
+        pass
+
+
+# Writes queued within this window share one fsync per file
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "10")) / 1000
+
+# One thread performs every commit, in order, so batches never overlap
+commit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="commit")
+
+
+class GroupCommitter:
+    """Durable writes where concurrent handlers share the fsync
+
+    Each write returns a future that resolves once the data is on disk.
+    In group mode the first write of a batch schedules a commit
+    GROUP_COMMIT_WINDOW later; the commit performs every queued write
+    (only the latest for whole-file JSON saves) and fsyncs each file once.
+    With group=False every write is committed and fsynced on its own.
+    Without a running loop (startup) writes are committed immediately.
+    Commits run on commit_executor unless a single-thread executor of
+    its own is passed.
+    """
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW, group=True, executor=None):
+        self.window = window
+        self.group = group
+        self.executor = executor or commit_executor
+        self.batch = []  # (operation, future)
+        self.commit_handle = None
+
+    def append(self, path, text):
+        return self._submit(('append', path, text))
+
+    def save_json(self, filename, data):
+        return self._submit(('json', filename, data))
+
+    def sync(self, file):
+        """fsync a file the caller already wrote to"""
+        return self._submit(('sync', file, None))
+
+    def _submit(self, operation):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._commit([operation])
+            return None
+
+        future = loop.create_future()
+        if not self.group:
+            self._run(loop, [(operation, future)])
+            return future
+
+        self.batch.append((operation, future))
+        if self.commit_handle is None:
+            self.commit_handle = loop.call_later(self.window, self._flush, loop)
+        return future
+
+    def _flush(self, loop):
+        batch, self.batch, self.commit_handle = self.batch, [], None
+        self._run(loop, batch)
+
+    def drain(self):
+        """Commit whatever is queued, waiting for it (used at shutdown)"""
+        if self.commit_handle:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        batch, self.batch = self.batch, []
+        self.executor.submit(self._commit, [operation for operation, _ in batch]).result()
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def _run(self, loop, batch):
+        done = loop.run_in_executor(self.executor, self._commit,
+                                    [operation for operation, _ in batch])
+        done.add_done_callback(lambda result: self._resolve(batch, result))
+
+    @staticmethod
+    def _resolve(batch, result):
+        error = result.exception()
+        for _, future in batch:
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    @staticmethod
+    def _commit(operations):
+        """Perform a batch of writes with one fsync per file (blocking)"""
+        appends = {}
+        json_saves = {}
+        files = []
+        for kind, target, data in operations:
+            if kind == 'append':
+                appends.setdefault(target, []).append(data)
+            elif kind == 'json':
+                json_saves[target] = data  # Later saves supersede earlier ones
+            elif target not in files:
+                files.append(target)
+
+        for path, texts in appends.items():
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(''.join(texts))
+                f.flush()
+                os.fsync(f.fileno())
+        for filename, data in json_saves.items():
+            if not save_json_data(filename, data, durable=True):
+                raise OSError(f"Could not save {filename}")
+        for file in files:
+            fsync_quietly(file)
+
+
+persistence = GroupCommitter(group=os.getenv("GROUP_COMMIT", "1") != "0")
+
+
+async def benchmark_commits(writes, group):
+    """Concurrent small appends -> (writes per second, p99 latency in seconds)
+
+    Runs on a commit thread of its own so the benchmark neither queues
+    behind nor delays the bot's real commits.
+    """
+    os.makedirs("downloads", exist_ok=True)
+    path = os.path.join("downloads", f"commit_bench_{time.time_ns()}.log")
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="commit-bench")
+    committer = GroupCommitter(group=group, executor=executor)
+    latencies = []
+
+    async def write(i):
+        started = time.perf_counter()
+        await committer.append(path, f"{{\"seq\": {i}}}\n")
+        latencies.append(time.perf_counter() - started)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(write(i) for i in range(writes)))
+        elapsed = time.perf_counter() - started
+    finally:
+        executor.shutdown(wait=False)
+        if os.path.exists(path):
+            os.remove(path)
+
+    latencies.sort()
+    return writes / elapsed, latencies[max(0, int(len(latencies) * 0.99) - 1)]
+
+
+class WriteAheadLog:
+    """Append-only JSON-lines log of state mutations since the last checkpoint
+
+    Each record is written as it happens and numbered; a checkpoint stores
+    the number it covers, so replay skips what the checkpoint already
+    holds. The fsyncs go through the group committer.
+
+    After a checkpoint the log is rotated: the live file becomes the
+    retired segment and a new file starts with the records the checkpoint
+    does not cover. The commit thread syncs the new file before deleting
+    the retired one, so the event loop never waits for the disk and a
+    crash in between only leaves records that replay reads twice (and
+    skips by number).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.retired_path = f"{path}.old"
+        self.seq = 0
+        self.pending = []  # Records not covered by a checkpoint yet
+        self.file = None
+
+    def replay(self, after_seq):
+        """Records newer than the checkpoint at after_seq, in order"""
+        records = []
+        last_seq = after_seq
+        torn = False
+        for path in (self.retired_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash; nothing after it was synced
+                        logger.warning(f"Ignoring torn record at the end of {path}")
+                        torn = True
+                        break
+                    if record['seq'] > last_seq:
+                        records.append(record)
+                        last_seq = record['seq']
+
+        self.seq = last_seq
+        self.pending = records
+        if self.file:
+            self.file.close()
+        if torn or os.path.exists(self.retired_path):
+            self._rewrite()  # Crash recovery: merge into one clean file
+        else:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        return records
+
+    def append(self, record):
+        self.seq += 1
+        record['seq'] = self.seq
+        self.pending.append(record)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        return persistence.sync(self.file)
+
+    def truncate_through(self, seq):
+        """Drop the records a durable checkpoint at seq has made redundant"""
+        self.pending = [record for record in self.pending if record['seq'] > seq]
+        if os.path.exists(self.retired_path):
+            # The previous rotation is not synced yet; the extra records
+            # in the live file are skipped by replay
+            return
+
+        retired_file = self.file
+        os.replace(self.path, self.retired_path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        for record in self.pending:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if not self.pending:
+            os.remove(self.retired_path)  # Nothing in it is needed any more
+        commit_executor.submit(self._retire, retired_file, self.file, self.retired_path)
+
+    @staticmethod
+    def _retire(retired_file, file, retired_path):
+        """Sync the new segment, then drop the retired one (commit thread)"""
+        fsync_quietly(retired_file)
+        retired_file.close()
+        fsync_quietly(file)
+        try:
+            os.remove(retired_path)
+        except FileNotFoundError:
+            pass
+
+    def _rewrite(self):
+        """Write the pending records to a fresh file (blocking; startup only)"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in self.pending:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        if os.path.exists(self.retired_path):
+            os.remove(self.retired_path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+
 def is_admin(user_id):
     """Check if user is admin"""
     return user_id in ADMIN_USER_IDS
 
+
+def current_stats_day(now=None):
+    """Date of the stats day in progress; days start at the reset time"""
+    now = now or datetime.now(RESET_TIMEZONE)
+    return (now - timedelta(hours=RESET_HOUR)).date()
+
+
+def next_reset_time(now=None):
+    """The next instant at which the daily stats roll over"""
+    now = now or datetime.now(RESET_TIMEZONE)
+    reset = now.replace(hour=RESET_HOUR, minute=0, second=0, microsecond=0)
+    if reset <= now:
+        reset += timedelta(days=1)  # Wall-clock arithmetic, so DST-safe
+    return reset
+
+
+def stats_day_of(timestamp):
+    """Stats day of a record's ISO timestamp (naive ones are server local time)"""
+    try:
+        moment = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    return current_stats_day(moment.astimezone(RESET_TIMEZONE))
+
+
+def backfill_daily_stats(before_date):
+    """Build daily rollups for days before before_date from the download history"""
+    rollups = {}
+    users = {}
+    for video in iter_download_records():
+        date = video.get('download_date', '')[:10]
+        if not date or date >= before_date:
+            continue
+        day = rollups.setdefault(date, {'downloads': 0, 'users': 0, 'bytes': 0,
+                                        'seconds': 0, 'formats': {}, 'failures': 0})
+        if not video.get('success', True):
+            day['failures'] += 1
+            continue
+        day['downloads'] += 1
+        day['bytes'] += video.get('file_size') or 0
+        day['seconds'] += int(video.get('duration') or 0)
+        format_code = video.get('format') or 'unknown'
+        day['formats'][format_code] = day['formats'].get(format_code, 0) + 1
+        users.setdefault(date, set()).add(video.get('user_id'))
+
+    for date, day_users in users.items():
+        rollups[date]['users'] = len(day_users)
+
+    save_json_data(DAILY_STATS_FILE, dict(sorted(rollups.items())))
+    logger.info(f"Backfilled daily stats for {len(rollups)} days")
+
+
+# Streaming import of large JSON files
+
+IMPORT_CHUNK_SIZE = 1024 * 1024
+IMPORT_BATCH_SIZE = 1000
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_container(path, chunk_size=IMPORT_CHUNK_SIZE):
+    """Yield the elements of a top-level JSON array, or the (key, value)
+    pairs of a top-level object, holding only about one element in memory
+
+    Parses with a raw_decode cursor over a buffer that is refilled from
+    the file whenever the next element is not complete in it yet.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size)
+        eof = not buffer
+        pos = JSON_WHITESPACE.match(buffer).end()
+        if pos >= len(buffer) or buffer[pos] not in '[{':
+            raise ValueError(f"{path} does not hold a JSON array or object")
+        is_object = buffer[pos] == '{'
+        pos += 1
+
+        while True:
+            pos = JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ',':
+                pos = JSON_WHITESPACE.match(buffer, pos + 1).end()
+            try:
+                if buffer[pos] in ']}':
+                    return
+                if is_object:
+                    key, pos_after = decoder.raw_decode(buffer, pos)
+                    pos_after = JSON_WHITESPACE.match(buffer, pos_after).end()
+                    if buffer[pos_after] != ':':
+                        raise ValueError(f"Expected ':' in {path}")
+                    pos_after = JSON_WHITESPACE.match(buffer, pos_after + 1).end()
+                    value, end = decoder.raw_decode(buffer, pos_after)
+                    item = (key, value)
+                else:
+                    item, end = decoder.raw_decode(buffer, pos)
+                # The element must be followed by a delimiter that is already
+                # in the buffer: "12" or "1." may continue in the next chunk
+                after = JSON_WHITESPACE.match(buffer, end).end()
+                if not eof and (after == len(buffer) or buffer[after] not in ',]}'):
+                    raise IndexError
+            except (IndexError, json.JSONDecodeError):
+                if eof:
+                    raise ValueError(f"{path} ends in the middle of an element")
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+
+class DownloadLog:
+    """Append-only JSON-lines log of downloads, addressed by position
+
+    Only the byte offset of each record is kept in memory (an array), so
+    any record is one seek away and the records themselves stay on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('q')
+        self.file = None
+        self.lock = Lock()  # Appends come from the event loop and from imports
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def load(self):
+        """Index the file and open it for appending (again, after a restore)"""
+        if self.file:
+            with self.lock:
+                self.file.close()
+        self.offsets = array('q')
+        offset = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    self.offsets.append(offset)
+                    offset += len(line)
+            if offset != os.path.getsize(self.path):
+                logger.warning(f"Dropping a torn record at the end of {self.path}")
+                with open(self.path, 'r+b') as f:
+                    f.truncate(offset)
+        self.file = open(self.path, 'ab')
+
+    def append(self, record):
+        """Append a record -> its position"""
+        return self.extend([record])
+
+    def extend(self, records):
+        """Append records with one write and one fsync -> position of the first"""
+        data = bytearray()
+        with self.lock:
+            first = len(self.offsets)
+            offset = self.file.tell()
+            for record in records:
+                self.offsets.append(offset + len(data))
+                data += (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+            self.file.write(data)
+            self.file.flush()
+        persistence.sync(self.file)
+        return first
+
+    def read(self, positions):
+        """Records at positions, in the order given"""
+        with open(self.path, 'rb') as f:
+            records = []
+            for position in positions:
+                f.seek(self.offsets[position])
+                records.append(json.loads(f.readline()))
+            return records
+
+    def __iter__(self):
+        """Stream every record from disk"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    yield json.loads(line)
+
+
+download_log = DownloadLog(DOWNLOAD_LOG_FILE)
+
+
+def iter_download_records():
+    """Every download record, from the log or from a not yet imported legacy file"""
+    if os.path.exists(DOWNLOAD_LOG_FILE):
+        return iter(download_log)
+    if os.path.exists(VIDEOS_DATA_FILE):
+        return iter_json_container(VIDEOS_DATA_FILE)
+    return iter(())
+
+
+def import_legacy_videos(path, progress=None, log=None):
+    """Stream a legacy videos_data.json array into a download log in batches
+
+    Blocking; progress(rows, rows_per_second) is called after every batch.
+    log defaults to download_log. Returns (rows, rows_per_second).
+    A first pass only parses, so a file that is not an array of records
+    raises ValueError before anything is appended.
+    """
+    if log is None:
+        log = download_log
+    started = time.perf_counter()
+    for index, record in enumerate(iter_json_container(path)):
+        if not isinstance(record, dict):
+            raise ValueError(f"{path} is not an array of video records (element {index})")
+
+    rows = 0
+    batch = []
+    for record in iter_json_container(path):
+        batch.append(record)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            log.extend(batch)
+            rows += len(batch)
+            batch = []
+            if progress:
+                progress(rows, rows / (time.perf_counter() - started))
+    if batch:
+        log.extend(batch)
+        rows += len(batch)
+    return rows, rows / max(time.perf_counter() - started, 1e-9)
+
+
+def migrate_legacy_videos():
+    """Move videos_data.json into the empty download log (at startup)
+
+    The import goes to a staging log, which replaces the real one only
+    after the legacy file is renamed. A crash part way through leaves the
+    legacy file in place and the import starts over; a crash after the
+    rename leaves a complete staging log, which is swapped in.
+    """
+    staging_path = f"{DOWNLOAD_LOG_FILE}.import"
+    if os.path.exists(VIDEOS_DATA_FILE) and not len(download_log):
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+        staging = DownloadLog(staging_path)
+        staging.load()
+        rows, rate = import_legacy_videos(
+            VIDEOS_DATA_FILE,
+            lambda rows, rate: print(f"   ... {rows} videos imported ({rate:.0f} rows/s)"),
+            staging)
+        staging.file.close()
+        os.replace(VIDEOS_DATA_FILE, f"{VIDEOS_DATA_FILE}.migrated")
+        print(f"✅ Imported {rows} videos into the download log ({rate:.0f} rows/s)")
+    if os.path.exists(staging_path) and not os.path.exists(VIDEOS_DATA_FILE):
+        os.replace(staging_path, DOWNLOAD_LOG_FILE)
+        download_log.load()
+
+
+# Rate limiting
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets kept in parallel arrays with reusable slots"""
+
+    def __init__(self, capacity, refill_per_hour):
+        self.capacity = float(capacity)
+        self.refill_rate = refill_per_hour / 3600.0  # Tokens per second
+        self.slots = {}           # Key -> index into tokens/updated
+        self.tokens = array('d')
+        self.updated = array('d')
+        self.free_slots = []      # Indexes of buckets that refilled completely
+
+    @classmethod
+    def per_window(cls, count, window_seconds):
+        """N per rolling window: a bucket of N that refills over the window"""
+        return cls(count, count * 3600.0 / window_seconds)
+
+    def available(self, key, now=None):
+        """Tokens key could spend right now"""
+        slot = self.slots.get(key)
+        if slot is None:
+            return self.capacity
+
+        now = now or time.time()
+        level = min(self.capacity,
+                    self.tokens[slot] + (now - self.updated[slot]) * self.refill_rate)
+        if level >= self.capacity:
+            # A full bucket is the same as no state; hand the slot back
+            del self.slots[key]
+            self.free_slots.append(slot)
+        return level
+
+    def charge(self, key, cost=1, now=None):
+        """Take cost tokens from key's bucket, going into debt if needed"""
+        now = now or time.time()
+        level = self.available(key, now)
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                slot = len(self.tokens)
+                self.tokens.append(0.0)
+                self.updated.append(0.0)
+            self.slots[key] = slot
+        self.tokens[slot] = level - cost
+        self.updated[slot] = now
+
+    def retry_after(self, key, cost=1, now=None):
+        """Seconds until key can afford cost"""
+        missing = cost - self.available(key, now)
+        if missing <= 0:
+            return 0
+        return missing / self.refill_rate if self.refill_rate else float('inf')
+
+    def clear(self):
+        self.slots.clear()
+        self.tokens = array('d')
+        self.updated = array('d')
+        self.free_slots = []
+
+    def to_dict(self):
+        return {str(key): [self.tokens[slot], self.updated[slot]]
+                for key, slot in self.slots.items()}
+
+    def load(self, data):
+        self.clear()
+        for key, (tokens, updated) in data.items():
+            self.slots[int(key)] = len(self.tokens)
+            self.tokens.append(tokens)
+            self.updated.append(updated)
+
+
+class SlidingWindowCounter:
+    """Rolling-window total estimated from the current and previous window"""
+
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self.window_start = 0.0
+        self.current = 0.0
+        self.previous = 0.0
+
+    def _rotate(self, now):
+        elapsed = now - self.window_start
+        if elapsed >= self.window:
+            self.previous = self.current if elapsed < 2 * self.window else 0.0
+            self.current = 0.0
+            self.window_start = now - elapsed % self.window
+
+    def count(self, now=None):
+        """Weighted total over the last window_seconds"""
+        now = now or time.time()
+        self._rotate(now)
+        weight = 1 - (now - self.window_start) / self.window
+        return self.previous * weight + self.current
+
+    def add(self, amount=1, now=None):
+        self._rotate(now or time.time())
+        self.current += amount
+
+    def clear(self):
+        self.window_start = self.current = self.previous = 0.0
+
+    def to_dict(self):
+        return [self.window_start, self.current, self.previous]
+
+    def load(self, data):
+        self.window_start, self.current, self.previous = data
+
+
+class RollingUserSet:
+    """Distinct users seen within a rolling window"""
+
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self.last_seen = OrderedDict()  # user_id -> time, oldest first
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        while self.last_seen and next(iter(self.last_seen.values())) <= cutoff:
+            self.last_seen.popitem(last=False)
+
+    def __contains__(self, user_id):
+        self._expire(time.time())
+        return user_id in self.last_seen
+
+    def __len__(self):
+        self._expire(time.time())
+        return len(self.last_seen)
+
+    def add(self, user_id, now=None):
+        self.last_seen[user_id] = now or time.time()
+        self.last_seen.move_to_end(user_id)
+
+    def clear(self):
+        self.last_seen.clear()
+
+    def to_dict(self):
+        return {str(user_id): seen for user_id, seen in self.last_seen.items()}
+
+    def load(self, data):
+        self.last_seen = OrderedDict(
+            sorted(((int(user_id), seen) for user_id, seen in data.items()),
+                   key=lambda item: item[1]))
+
+
+# Set while /adminrestore replaces the data files. The stores whose
+# in-memory state is about to be reloaded skip their saves, so they
+# cannot write the old state over the restored files.
+data_files_frozen = False
+
 # Global state management for strict limits
 
+# A checkpoint of bot_data is written once this many WAL records pile up
+WAL_CHECKPOINT_RECORDS = 100
+
+# A slot held longer than this is assumed stuck and handed back
+DOWNLOAD_LEASE_TIMEOUT = 30 * 60
+
+
+class DownloadLease:
+    """A reserved download slot that is released exactly once
+
+    On timeout the slot is handed back but the outcome stays open: a job
+    that finishes late still releases its lease, and a success is charged.
+    """
+
+    def __init__(self, limits, user_id, timeout):
+        self.limits = limits
+        self.user_id = user_id
+        self.released = False
+        self.expired = False
+        self.estimate = None
+        self.timer = asyncio.get_running_loop().call_later(timeout, self._expire)
+
+    def release(self, success=False, usage=None):
+        """Give the slot back, charging usage (bytes/seconds) on success"""
+        if self.released:
+            return
+        self.released = True
+        if self.expired:
+            # The slot (maybe the user's next one by now) is not ours to free
+            self.limits.record_outcome(self.user_id, success, usage or self.estimate)
+            return
+        self.timer.cancel()
+        self.limits.complete_download(self.user_id, success, usage)
+
+    def _expire(self):
+        logger.warning(f"Download lease for user {self.user_id} timed out")
+        self.expired = True
+        self.estimate = self.limits.free_slot(self.user_id)
+
 
 class BotLimits:
     def __init__(self):
@@ -93,47 +837,192 @@ class BotLimits:
         self.max_videos_per_user = 2
         self.max_total_daily_downloads = 3
 
+        # Budgets in bytes transferred and seconds of media, which reflect
+        # the real cost of a download better than counts do
+        self.max_bytes_per_user = 150 * 1024 * 1024
+        self.max_seconds_per_user = 20 * 60
+        self.max_total_daily_bytes = 400 * 1024 * 1024
+        self.max_total_daily_seconds = 60 * 60
+
+        # Limits are enforced over a rolling 24h rather than per calendar
+        # day. Any bucket can instead be given as burst/refill, e.g.
+        # TokenBucketLimiter(capacity=3, refill_per_hour=0.5)
+        self.user_buckets = TokenBucketLimiter.per_window(
+            self.max_videos_per_user, DAY_SECONDS)
+        self.download_window = SlidingWindowCounter(DAY_SECONDS)
+        self.user_window = RollingUserSet(DAY_SECONDS)
+        self.user_byte_buckets = TokenBucketLimiter.per_window(
+            self.max_bytes_per_user, DAY_SECONDS)
+        self.user_second_buckets = TokenBucketLimiter.per_window(
+            self.max_seconds_per_user, DAY_SECONDS)
+        self.byte_window = SlidingWindowCounter(DAY_SECONDS)
+        self.second_window = SlidingWindowCounter(DAY_SECONDS)
+
         self.active_downloads = set()  # Track active download user_ids
+        self.in_flight_costs = {}      # user_id -> estimated cost of that download
+        self.lock = asyncio.Lock()     # Serializes slot reservations
+
+        # Counter mutations go to the WAL; bot_data.json is the checkpoint,
+        # written off the event loop and coalesced
+        self.wal = WriteAheadLog(BOT_DATA_WAL_FILE)
+        self.save_task = None
+        self.save_dirty = False
 
+        self.load_state()
+
+    def load_state(self):
+        """Load the bot_data.json checkpoint and replay the WAL on top"""
         # Load or initialize bot data
         self.bot_data = load_json_data(BOT_DATA_FILE, {
-            'last_reset_date': str(datetime.now().date()),
+            'last_reset_date': str(current_stats_day()),
             'total_downloads_today': 0,
+            'bytes_today': 0,
+            'seconds_today': 0,
+            'failures_today': 0,
+            'formats_today': {},
             'users_today': [],
             'user_downloads_today': {},
             'total_users': 0,
             'total_downloads_all_time': 0,
-            'bot_start_date': str(datetime.now().date())
+            'bot_start_date': str(current_stats_day())
         })
 
-        # Reset if needed on startup
-        self.reset_daily_stats_if_needed()
+        rate_limits = self.bot_data.pop('rate_limits', None)
+        self.clear_rate_limits()
+        if rate_limits:
+            self.user_buckets.load(rate_limits['user_buckets'])
+            self.download_window.load(rate_limits['downloads'])
+            self.user_window.load(rate_limits['users'])
+            self.user_byte_buckets.load(rate_limits.get('user_bytes', {}))
+            self.user_second_buckets.load(rate_limits.get('user_seconds', {}))
+            self.byte_window.load(rate_limits.get('bytes', [0.0, 0.0, 0.0]))
+            self.second_window.load(rate_limits.get('seconds', [0.0, 0.0, 0.0]))
+        self.users_today = set(self.bot_data['users_today'])
+        for key, default in (('bytes_today', 0), ('seconds_today', 0),
+                             ('failures_today', 0), ('formats_today', {})):
+            self.bot_data.setdefault(key, default)
+
+        records = self.wal.replay(self.bot_data.pop('wal_seq', 0))
+        for record in records:
+            self.apply(record)
+        if records:
+            logger.info(f"Replayed {len(records)} WAL records over the checkpoint")
+
+        # Days before this feature only exist in the download history
+        if not os.path.exists(DAILY_STATS_FILE):
+            backfill_daily_stats(self.bot_data['last_reset_date'])
+
+        # Catch up on a reset missed while the bot was down
+        self.roll_over_day()
+
+    def roll_over_day(self):
+        """Close the finished stats day into its history record and start a new one
+
+        Runs from daily_reset_scheduler at the reset instant (and once at
+        startup), so the limit checks never look at the date themselves.
+        """
+        current_date = str(current_stats_day())
+        finished_date = self.bot_data.get('last_reset_date')
+        if current_date == finished_date or data_files_frozen:
+            return  # A restore rolls the restored state over when it loads
+
+        logger.info(f"Resetting daily stats for new day: {current_date}")
+
+        # History first: rewriting the same date after a crash is harmless
+        daily_stats = load_json_data(DAILY_STATS_FILE, {})
+        daily_stats[finished_date] = self.today_rollup()
+        save_json_data(DAILY_STATS_FILE, daily_stats)
+
+        # Reset daily counters (no await in between, so no handler sees a mix)
+        self.log({'op': 'reset', 'date': current_date})
+
+        # Checkpoint the fresh day
+        self.schedule_save()
+
+        logger.info("Daily stats have been reset successfully")
+
+    def log(self, record):
+        """Append a counter mutation to the WAL, then apply it"""
+        self.wal.append(record)
+        self.apply(record)
+        if len(self.wal.pending) >= WAL_CHECKPOINT_RECORDS:
+            self.schedule_save()
+
+    def apply(self, record):
+        """Apply one WAL record to bot_data and the rolling limits
+
+        Also used for replay, so it depends only on the record (and on
+        the record's own timestamp, never the current time).
+        """
+        op = record['op']
+        if op == 'download':
+            user_id = record['user']
+            now = record['t']
+            usage = record.get('usage')
 
-    def reset_daily_stats_if_needed(self):
-        """Reset stats if it's a new day"""
-        current_date = str(datetime.now().date())
+            # Update daily stats
+            self.bot_data['total_downloads_today'] += 1
+            self.bot_data['total_downloads_all_time'] += 1
+
+            # Charge the rolling limits
+            self.user_buckets.charge(user_id, 1, now)
+            self.download_window.add(1, now)
+            self.user_window.add(user_id, now)
+
+            if usage:
+                self.user_byte_buckets.charge(user_id, usage['bytes'], now)
+                self.user_second_buckets.charge(user_id, usage['seconds'], now)
+                self.byte_window.add(usage['bytes'], now)
+                self.second_window.add(usage['seconds'], now)
+                self.bot_data['bytes_today'] += usage['bytes']
+                self.bot_data['seconds_today'] += usage['seconds']
+                if usage.get('format'):
+                    formats = self.bot_data['formats_today']
+                    formats[usage['format']] = formats.get(usage['format'], 0) + 1
 
-        if current_date != self.bot_data.get('last_reset_date'):
-            logger.info(f"Resetting daily stats for new day: {current_date}")
+            # Add user to today's users if not already there
+            if user_id not in self.users_today:
+                self.users_today.add(user_id)
+                self.bot_data['users_today'].append(user_id)
 
-            # Reset daily counters
-            self.bot_data['last_reset_date'] = current_date
+            # Update user's daily download count
+            user_key = str(user_id)
+            self.bot_data['user_downloads_today'][user_key] = self.bot_data['user_downloads_today'].get(
+                user_key, 0) + 1
+        elif op == 'failure':
+            self.bot_data['failures_today'] += 1
+        elif op == 'new_user':
+            self.bot_data['total_users'] += 1
+        elif op == 'reset':
+            self.bot_data['last_reset_date'] = record['date']
             self.bot_data['total_downloads_today'] = 0
             self.bot_data['users_today'] = []
             self.bot_data['user_downloads_today'] = {}
+            self.bot_data['bytes_today'] = 0
+            self.bot_data['seconds_today'] = 0
+            self.bot_data['failures_today'] = 0
+            self.bot_data['formats_today'] = {}
+            self.users_today.clear()
+            if record.get('clear_limits'):
+                self.clear_rate_limits()
+
+    def today_rollup(self):
+        """Compact summary of the stats day in progress"""
+        return {
+            'downloads': self.bot_data['total_downloads_today'],
+            'users': len(self.bot_data['users_today']),
+            'bytes': self.bot_data['bytes_today'],
+            'seconds': self.bot_data['seconds_today'],
+            'formats': dict(self.bot_data['formats_today']),
+            'failures': self.bot_data['failures_today']
+        }
 
-            # Clear active downloads (in case of bot restart)
-            self.active_downloads.clear()
-
-            # Save the reset data
-            save_json_data(BOT_DATA_FILE, self.bot_data)
-
-            logger.info("Daily stats have been reset successfully")
-
-    def can_user_download(self, user_id):
-        """Check if user can make a download request"""
-        self.reset_daily_stats_if_needed()
+    def can_user_download(self, user_id, estimate=None):
+        """Check if user can make a download request
 
+        estimate is the probed cost, {'bytes': ..., 'seconds': ...}; without
+        it only the count-based limits are checked.
+        """
         # Check if user is already downloading
         if user_id in self.active_downloads:
             return False, "❌ You already have an active download. Please wait."
@@ -142,132 +1031,1469 @@ class BotLimits:
         if len(self.active_downloads) >= self.max_concurrent_downloads:
             return False, f"⏳ Server busy. Maximum {self.max_concurrent_downloads} downloads allowed simultaneously."
 
-        # Check daily total downloads limit
-        if self.bot_data['total_downloads_today'] >= self.max_total_daily_downloads:
-            return False, f"📊 Daily limit reached. Maximum {self.max_total_daily_downloads} downloads per day for all users."
+        # Check rolling 24h downloads limit (in-flight downloads count too)
+        if self.download_window.count() + len(self.active_downloads) >= self.max_total_daily_downloads:
+            return False, f"📊 Daily limit reached. Maximum {self.max_total_daily_downloads} downloads per 24 hours for all users."
+
+        # Check rolling 24h users limit (users with a download in flight count too)
+        if user_id not in self.user_window:
+            pending_users = sum(1 for active in self.active_downloads
+                                if active not in self.user_window)
+            if len(self.user_window) + pending_users >= self.max_users_per_day:
+                return False, f"👥 Daily user limit reached. Maximum {self.max_users_per_day} users can download per 24 hours."
 
-        # Check daily users limit
-        if len(self.bot_data['users_today']) >= self.max_users_per_day and user_id not in self.bot_data['users_today']:
-            return False, f"👥 Daily user limit reached. Maximum {self.max_users_per_day} users can download per day."
+        # Check user's own bucket
+        if self.user_buckets.available(user_id) < 1:
+            wait = format_eta(self.user_buckets.retry_after(user_id))
+            return False, f"🎥 You've reached your limit of {self.max_videos_per_user} videos per 24 hours. Try again in {wait}."
 
-        # Check user's daily video limit
-        user_downloads_today = self.bot_data['user_downloads_today'].get(
-            str(user_id), 0)
-        if user_downloads_today >= self.max_videos_per_user:
-            return False, f"🎥 You've reached your daily limit of {self.max_videos_per_user} videos."
+        if estimate:
+            return self._check_budgets(user_id, estimate)
 
         return True, "✅ You can download"
 
-    def start_download(self, user_id):
-        """Mark user as having started a download"""
-        self.active_downloads.add(user_id)
+    def _check_budgets(self, user_id, estimate):
+        """Check the byte and media-time budgets against a cost estimate"""
+        cost_bytes = estimate['bytes']
+        cost_seconds = estimate['seconds']
 
-    def complete_download(self, user_id, success=True):
-        """Mark download as completed"""
+        if cost_bytes > self.max_bytes_per_user or cost_seconds > self.max_seconds_per_user:
+            return False, f"📦 This video (~{format_bytes(cost_bytes)}) is larger than your whole 24 hour budget."
+
+        if self.user_byte_buckets.available(user_id) < cost_bytes:
+            wait = format_eta(self.user_byte_buckets.retry_after(user_id, cost_bytes))
+            return False, f"📦 This video (~{format_bytes(cost_bytes)}) would exceed your data budget of {format_bytes(self.max_bytes_per_user)} per 24 hours. Try again in {wait}."
+
+        if self.user_second_buckets.available(user_id) < cost_seconds:
+            wait = format_eta(self.user_second_buckets.retry_after(user_id, cost_seconds))
+            return False, f"⏳ This video would exceed your {self.max_seconds_per_user // 60} minutes of video per 24 hours. Try again in {wait}."
+
+        # In-flight downloads count against the global budgets too
+        reserved_bytes = sum(cost['bytes'] for cost in self.in_flight_costs.values())
+        reserved_seconds = sum(cost['seconds'] for cost in self.in_flight_costs.values())
+        if self.byte_window.count() + reserved_bytes + cost_bytes > self.max_total_daily_bytes:
+            return False, "📦 Server data budget reached for now. Please try a shorter video or try again later."
+        if self.second_window.count() + reserved_seconds + cost_seconds > self.max_total_daily_seconds:
+            return False, "⏳ Server video-time budget reached for now. Please try a shorter video or try again later."
+
+        return True, "✅ You can download"
+
+    async def reserve(self, user_id, estimate=None, timeout=DOWNLOAD_LEASE_TIMEOUT):
+        """Atomically check the limits and claim a slot
+
+        Returns (lease, message); lease is None when the user was refused.
+        """
+        async with self.lock:
+            can_download, message = self.can_user_download(user_id, estimate)
+            if not can_download:
+                return None, message
+            self.active_downloads.add(user_id)
+            if estimate:
+                self.in_flight_costs[user_id] = estimate
+            return DownloadLease(self, user_id, timeout), message
+
+    def complete_download(self, user_id, success=True, usage=None):
+        """Mark download as completed (called by DownloadLease.release)
+
+        usage is the actual cost (bytes, seconds and format); the
+        reservation's estimate is charged when it is missing.
+        """
+        estimate = self.free_slot(user_id)
+        self.record_outcome(user_id, success, usage or estimate)
+
+    def free_slot(self, user_id):
+        """Hand back the user's slot; returns its reserved estimate"""
         self.active_downloads.discard(user_id)
+        return self.in_flight_costs.pop(user_id, None)
 
+    def record_outcome(self, user_id, success, usage=None):
+        """Charge a finished download, or count a failure"""
         if success:
-            self.reset_daily_stats_if_needed()
+            self.log({'op': 'download', 'user': user_id, 't': time.time(),
+                      'usage': usage})
+        else:
+            self.log({'op': 'failure'})
 
-            # Update daily stats
-            self.bot_data['total_downloads_today'] += 1
-            self.bot_data['total_downloads_all_time'] += 1
+    def checkpoint(self):
+        """Write the checkpoint synchronously and trim the WAL"""
+        snapshot = self.state_snapshot()
+        save_json_data(BOT_DATA_FILE, snapshot, durable=True)
+        self.wal.truncate_through(snapshot['wal_seq'])
 
-            # Add user to today's users if not already there
-            if user_id not in self.bot_data['users_today']:
-                self.bot_data['users_today'].append(user_id)
+    def schedule_save(self):
+        """Checkpoint bot_data off the event loop, coalescing bursts of updates"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Startup, no loop yet
+            self.checkpoint()
+            return
+
+        if data_files_frozen:
+            return  # The WAL keeps the records until the next checkpoint
+        if self.save_task and not self.save_task.done():
+            self.save_dirty = True  # The running save will go round again
+            return
+        self.save_task = loop.create_task(self._save_async())
+
+    async def _save_async(self):
+        while not data_files_frozen:
+            self.save_dirty = False
+            snapshot = self.state_snapshot()
+            try:
+                await persistence.save_json(BOT_DATA_FILE, snapshot)
+                self.wal.truncate_through(snapshot['wal_seq'])
+            except OSError:
+                pass  # Logged by save_json_data; the WAL still has everything
+            if not self.save_dirty:
+                break
+
+    def state_snapshot(self):
+        """Copy of bot_data plus the rolling limits, safe to write from a thread"""
+        snapshot = copy.deepcopy(self.bot_data)
+        snapshot['rate_limits'] = self.rate_limits_state()
+        snapshot['wal_seq'] = self.wal.seq
+        return snapshot
+
+    def rate_limits_state(self):
+        """Serializable state of the rolling limits"""
+        return {
+            'user_buckets': self.user_buckets.to_dict(),
+            'downloads': self.download_window.to_dict(),
+            'users': self.user_window.to_dict(),
+            'user_bytes': self.user_byte_buckets.to_dict(),
+            'user_seconds': self.user_second_buckets.to_dict(),
+            'bytes': self.byte_window.to_dict(),
+            'seconds': self.second_window.to_dict()
+        }
+
+    def clear_rate_limits(self):
+        """Refill every bucket and forget the rolling windows"""
+        self.user_buckets.clear()
+        self.download_window.clear()
+        self.user_window.clear()
+        self.user_byte_buckets.clear()
+        self.user_second_buckets.clear()
+        self.byte_window.clear()
+        self.second_window.clear()
+
+    def remaining_for(self, user_id):
+        """Whole downloads the user can start right now"""
+        return int(self.user_buckets.available(user_id))
+
+    def get_stats(self):
+        """Get current bot statistics"""
+        return {
+            'active_downloads': len(self.active_downloads),
+            'daily_downloads': self.bot_data['total_downloads_today'],
+            'users_today': len(self.bot_data['users_today']),
+            'remaining_downloads': self.max_total_daily_downloads - self.bot_data['total_downloads_today'],
+            'rolling_downloads': int(self.download_window.count()),
+            'rolling_users': len(self.user_window),
+            'rolling_bytes': int(self.byte_window.count()),
+            'rolling_seconds': int(self.second_window.count()),
+            'total_downloads_all_time': self.bot_data['total_downloads_all_time'],
+            'total_users': self.bot_data['total_users'],
+            'bot_start_date': self.bot_data['bot_start_date']
+        }
+
+
+# Initialize limits manager
+limits = BotLimits()
+
+# Load-based admission control
+
+ADMISSION_INTERVAL = 10                   # Seconds between load samples
+MIN_CONCURRENT_DOWNLOADS = 1
+MAX_CONCURRENT_DOWNLOADS = 6
+MAX_LOAD_PER_CPU = 1.5
+MIN_FREE_DISK_BYTES = 500 * 1024 * 1024
+MAX_LOOP_LAG = 0.5                        # Seconds
+MIN_SPEED_PER_DOWNLOAD = 100 * 1024       # Bytes/s once several run at once
+
+
+class AdmissionController:
+    """Raise or lower max_concurrent_downloads with host load (AIMD)"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.inputs = {}                   # Latest sample, exposed as metrics
+        self.decisions = deque(maxlen=20)  # Recent limit changes
+        self.upload_speed = 0.0            # Moving average, bytes/s
+
+    def record_upload(self, size, seconds):
+        """Fold a finished Telegram upload into the upload speed average"""
+        if seconds > 0:
+            self.upload_speed = 0.7 * self.upload_speed + 0.3 * (size / seconds)
+
+    def sample(self, loop_lag):
+        """Collect the current load signals"""
+        load_per_cpu = None
+        if hasattr(os, 'getloadavg'):  # Not available on Windows
+            load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+
+        downloading = [data for data in progress_data.values()
+                       if data.get('status') == 'downloading']
+
+        return {
+            'load_per_cpu': load_per_cpu,
+            'free_disk_bytes': shutil.disk_usage("downloads").free,
+            'downloading': len(downloading),
+            'download_speed': sum(data.get('speed') or 0 for data in downloading),
+            'upload_speed': self.upload_speed,
+            'loop_lag': loop_lag,
+            'active_downloads': len(self.limits.active_downloads)
+        }
+
+    @staticmethod
+    def overload_reasons(inputs):
+        """Return why the host counts as overloaded (empty if it does not)"""
+        reasons = []
+        if inputs['load_per_cpu'] is not None and inputs['load_per_cpu'] > MAX_LOAD_PER_CPU:
+            reasons.append(f"load {inputs['load_per_cpu']:.2f}/cpu")
+        if inputs['free_disk_bytes'] < MIN_FREE_DISK_BYTES:
+            reasons.append(f"free disk {format_bytes(inputs['free_disk_bytes'])}")
+        if inputs['loop_lag'] > MAX_LOOP_LAG:
+            reasons.append(f"event loop lag {inputs['loop_lag']:.2f}s")
+        downloading = inputs['downloading']
+        if downloading >= 2 and inputs['download_speed'] / downloading < MIN_SPEED_PER_DOWNLOAD:
+            reasons.append(f"download speed {format_speed(inputs['download_speed'] / downloading)} each")
+        return reasons
+
+    def adjust(self, inputs):
+        """Halve the limit under overload, add one while it is saturated"""
+        current = self.limits.max_concurrent_downloads
+        reasons = self.overload_reasons(inputs)
+
+        if reasons:
+            new_limit = max(MIN_CONCURRENT_DOWNLOADS, current // 2)
+            reason = ", ".join(reasons)
+        elif inputs['active_downloads'] >= current:
+            new_limit = min(MAX_CONCURRENT_DOWNLOADS, current + 1)
+            reason = "all slots busy, host healthy"
+        else:
+            new_limit = current
+            reason = ""
+
+        if new_limit != current:
+            logger.info(f"Concurrent downloads {current} -> {new_limit}: {reason}")
+            self.decisions.append({
+                'time': datetime.now().isoformat(),
+                'from': current,
+                'to': new_limit,
+                'reason': reason
+            })
+        self.limits.max_concurrent_downloads = new_limit
+        self.inputs = inputs
+
+    async def run(self):
+        """Sample and adjust forever; the sleep overrun measures loop lag"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(ADMISSION_INTERVAL)
+            loop_lag = max(0.0, loop.time() - started - ADMISSION_INTERVAL)
+            try:
+                self.adjust(self.sample(loop_lag))
+            except Exception as e:
+                logger.error(f"Admission control error: {e}")
+
+
+admission = AdmissionController(limits)
+
+
+async def daily_reset_scheduler():
+    """Roll the daily stats over exactly at each configured reset instant"""
+    while True:
+        target = next_reset_time().timestamp()
+        # Sleep in bounded steps so a suspended host or clock jump is noticed
+        while (remaining := target - time.time()) > 0:
+            await asyncio.sleep(min(remaining, 3600))
+        try:
+            limits.roll_over_day()
+        except Exception as e:
+            logger.error(f"Daily reset error: {e}")
+
+
+@flask_app.route('/metrics')
+def metrics():
+    """Admission control inputs and decisions in Prometheus text format"""
+    lines = [
+        f"bot_max_concurrent_downloads {limits.max_concurrent_downloads}",
+        f"bot_admission_decisions_total {len(admission.decisions)}"
+    ]
+    for name, value in admission.inputs.items():
+        if value is not None:
+            lines.append(f"bot_{name} {value}")
+    return Response("\n".join(lines) + "\n", mimetype="text/plain")
+
+
+# Materialized admin statistics
+
+# Size of the recent-downloads ring shown by /adminstats
+RECENT_DOWNLOADS_SIZE = 50
+
+# Entries per page of /adminusers and /adminvideos
+ADMIN_PAGE_SIZE = 10
+
+
+class SortedIndex:
+    """Secondary index of (key, id) pairs kept in key order, one pair per id
+
+    Pages are cut with bisect from a cursor (the last pair shown), so a
+    page costs O(log n + page size) no matter how deep it is.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, item_id, key):
+        old_key = self.keys.get(item_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            del self.entries[bisect_left(self.entries, (old_key, item_id))]
+        self.keys[item_id] = key
+        insort(self.entries, (key, item_id))
+
+    def page(self, cursor=None, older=True, size=ADMIN_PAGE_SIZE):
+        """Newest-first page next to cursor -> (entries, has_older, has_newer)"""
+        if older:
+            end = len(self.entries) if cursor is None else bisect_left(self.entries, cursor)
+            start = max(0, end - size)
+        else:
+            start = bisect_right(self.entries, cursor)
+            end = min(len(self.entries), start + size)
+        return self.entries[start:end][::-1], start > 0, end < len(self.entries)
+
+
+class AdminStats:
+    """Admin aggregates kept up to date on every write
+
+    The admin commands read these instead of loading and sorting the
+    whole users/videos history on each call.
+    """
+
+    def __init__(self):
+        self.total_users = 0
+        self.total_videos = 0
+        self.failed_videos = 0
+        self.total_bytes = 0
+        self.formats = {}
+        self.per_day = {}
+        self.recent = deque(maxlen=RECENT_DOWNLOADS_SIZE)
+        self.users_by_last_seen = SortedIndex()
+        self.videos_by_date = SortedIndex()
+        self.videos_by_user = {}  # user_key -> positions in the download log
+
+    def load(self):
+        """Load the aggregates, rebuilding them from the history files if missing"""
+        data = load_json_data(ADMIN_STATS_FILE)
+        if not data:
+            self.rebuild()
+            return
+        self.index_videos()
+        self.index_users()  # Counts the loaded profiles
+        self.total_videos = data['total_videos']
+        self.failed_videos = data['failed_videos']
+        self.total_bytes = data['total_bytes']
+        self.formats = data['formats']
+        self.per_day = data['per_day']
+        self.recent.extend(data['recent'])
+
+    def rebuild(self):
+        """Recompute everything from the user profiles and the download log"""
+        self.rebuild_videos()
+        self.index_users()
+        self.save()
+
+    def rebuild_videos(self):
+        """Recompute the download aggregates and indexes from the download log
+
+        Only reads the log, so it may run in a thread; index_users() and
+        save() have to follow on the event loop.
+        """
+        self.__init__()
+        for video in download_log:
+            self.record_video(video)
+        self.index_videos()
+        logger.info(f"Rebuilt admin stats from {self.total_videos} video records")
+
+    def index_users(self):
+        """Count and sort the user profiles (on the event loop, which owns them)"""
+        self.total_users = len(user_store.profiles)
+        self.users_by_last_seen.entries = sorted(
+            (profile.last_seen, user_key) for user_key, profile in user_store.profiles.items())
+        self.users_by_last_seen.keys = {
+            user_key: key for key, user_key in self.users_by_last_seen.entries}
+
+    def index_videos(self):
+        """Sort the history once at startup; writes keep it sorted afterwards"""
+        entries = []
+        self.videos_by_user = {}
+        for position, video in enumerate(download_log):
+            entries.append((video.get('download_date', ''), position))
+            self.videos_by_user.setdefault(str(video.get('user_id')), []).append(position)
+        entries.sort()
+        self.videos_by_date.entries = entries
+        self.videos_by_date.keys = {position: key for key, position in entries}
+
+    def save(self):
+        persistence.save_json(ADMIN_STATS_FILE, self.to_dict())
+
+    def to_dict(self):
+        return {
+            'total_users': self.total_users,
+            'total_videos': self.total_videos,
+            'failed_videos': self.failed_videos,
+            'total_bytes': self.total_bytes,
+            'formats': dict(self.formats),
+            'per_day': dict(self.per_day),
+            'recent': list(self.recent)
+        }
+
+    def record_user(self):
+        self.total_users += 1
+
+    def record_video(self, video_record):
+        self.total_videos += 1
+        if not video_record.get('success', True):
+            self.failed_videos += 1
+        self.total_bytes += video_record.get('file_size') or 0
+        format_code = video_record.get('format') or 'unknown'
+        self.formats[format_code] = self.formats.get(format_code, 0) + 1
+        day = stats_day_of(video_record.get('download_date'))
+        date = day.isoformat() if day else ''
+        self.per_day[date] = self.per_day.get(date, 0) + 1
+        self.recent.append({
+            'user_id': video_record.get('user_id'),
+            'video_title': video_record.get('video_title', ''),
+            'format': video_record.get('format', ''),
+            'file_size': video_record.get('file_size', 0),
+            'download_date': video_record.get('download_date', '')
+        })
+
+    def latest(self, count):
+        """Most recent downloads first"""
+        return list(reversed(self.recent))[:count]
+
+
+admin_stats = AdminStats()
+
+# Download analytics
+
+
+class DownloadColumns:
+    """The download history as typed columns for admin reports
+
+    One array per field instead of a dict per record (about 35 bytes per
+    download instead of several hundred), with the format string
+    dictionary-encoded to a small integer code. Reports work on whole
+    columns with C-level builtins (slicing, Counter, compress, zip).
+    """
+
+    def __init__(self):
+        self.user_ids = array('q')
+        self.timestamps = array('d')
+        self.durations = array('f')
+        self.file_sizes = array('q')
+        self.format_codes = array('H')
+        self.successes = array('b')
+        self.format_names = []  # code -> format string
+        self.format_codes_by_name = {}
+        self.in_order = True    # timestamps ascending, so windows are a bisect
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def memory_bytes(self):
+        return sum(column.itemsize * len(column) for column in (
+            self.user_ids, self.timestamps, self.durations,
+            self.file_sizes, self.format_codes, self.successes))
+
+    def load(self):
+        self.__init__()
+        for video in download_log:
+            self.append(video)
+
+    def append(self, video):
+        date = video.get('download_date')
+        timestamp = datetime.fromisoformat(date).timestamp() if date else 0.0
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            self.in_order = False
+
+        format_name = video.get('format') or 'unknown'
+        format_code = self.format_codes_by_name.get(format_name)
+        if format_code is None:
+            format_code = self.format_codes_by_name[format_name] = len(self.format_names)
+            self.format_names.append(format_name)
+
+        self.user_ids.append(int(video.get('user_id') or 0))
+        self.timestamps.append(timestamp)
+        self.durations.append(float(video.get('duration') or 0))
+        self.file_sizes.append(int(video.get('file_size') or 0))
+        self.format_codes.append(format_code)
+        self.successes.append(1 if video.get('success', True) else 0)
+
+    def window(self, column, since):
+        """The part of column for downloads at or after since"""
+        if self.in_order:
+            return column[bisect_left(self.timestamps, since):]
+        return array(column.typecode, itertools.compress(
+            column, [timestamp >= since for timestamp in self.timestamps]))
+
+    def top_users(self, since, count=10):
+        """[(user_id, downloads, bytes)] for the most active users"""
+        users = self.window(self.user_ids, since)
+        downloads = Counter(users)
+        data = dict.fromkeys(downloads, 0)
+        for user_id, size in zip(users, self.window(self.file_sizes, since)):
+            data[user_id] += size
+        return [(user_id, count, data[user_id]) for user_id, count in downloads.most_common(count)]
+
+    def format_counts(self, since):
+        return [(self.format_names[code], count) for code, count in
+                Counter(self.window(self.format_codes, since)).most_common()]
+
+    def hour_histogram(self, since):
+        """Downloads per hour of the day in RESET_TIMEZONE
+
+        Each timestamp gets its own UTC offset, so days on both sides of
+        a DST change land in the right hour. Offsets only change on
+        quarter-hour boundaries, so they are looked up once per slot.
+        """
+        offsets = {}
+        hours = Counter()
+        for timestamp in self.window(self.timestamps, since):
+            slot = int(timestamp // 900)
+            offset = offsets.get(slot)
+            if offset is None:
+                offset = offsets[slot] = datetime.fromtimestamp(
+                    slot * 900, RESET_TIMEZONE).utcoffset().total_seconds()
+            hours[int((timestamp + offset) // 3600 % 24)] += 1
+        return [hours.get(hour, 0) for hour in range(24)]
+
+    def totals(self, since):
+        """(downloads, failures, bytes, seconds of media)"""
+        successes = self.window(self.successes, since)
+        return (len(successes), len(successes) - sum(successes),
+                sum(self.window(self.file_sizes, since)),
+                sum(self.window(self.durations, since)))
+
+
+analytics = DownloadColumns()
+
+# Download search
+
+# Word characters without the underscore; emoji, punctuation and
+# separators all split tokens
+SEARCH_TOKEN_RE = re.compile(r'[^\W_]+')
+# URL parts that nearly every record shares
+SEARCH_URL_STOP_TOKENS = {'http', 'https', 'www', 'm', 'com', 'be', 'watch', 'v'}
+SEARCH_RESULTS = 20
+# Intersect by bisect only when the other list is this many times longer
+SEARCH_BISECT_RATIO = 16
+
+
+def search_tokens(text):
+    """Case-folded, accent-stripped word tokens of text"""
+    text = unicodedata.normalize('NFKD', text or '').casefold()
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return SEARCH_TOKEN_RE.findall(text)
+
+
+class SearchIndex:
+    """Inverted index from title and URL tokens to download log positions
+
+    Positions are appended in log order, so every posting list is a sorted
+    array. An AND query starts from the shortest list and narrows it with
+    each longer one: bisect lookups when that list is much longer, a single
+    pass over it otherwise.
+    """
+
+    def __init__(self):
+        self.postings = {}  # token -> array of positions, ascending
+
+    def __len__(self):
+        return len(self.postings)
+
+    def load(self):
+        self.__init__()
+        for position, video in enumerate(download_log):
+            self.add(position, video)
+
+    def add(self, position, video):
+        tokens = set(search_tokens(video.get('video_title')))
+        tokens.update(token for token in search_tokens(video.get('video_url'))
+                      if token not in SEARCH_URL_STOP_TOKENS)
+        for token in tokens:
+            positions = self.postings.get(token)
+            if positions is None:
+                positions = self.postings[token] = array('I')
+            positions.append(position)
+
+    def search(self, query):
+        """Positions of the records containing every token of query, ascending"""
+        tokens = set(search_tokens(query))
+        # URL tokens were indexed without the stop tokens, so a pasted URL
+        # has to lose them too; alone they still search titles
+        if tokens - SEARCH_URL_STOP_TOKENS:
+            tokens -= SEARCH_URL_STOP_TOKENS
+        if not tokens:
+            return []
+        postings = sorted((self.postings.get(token, ()) for token in tokens), key=len)
+        matches = postings[0]
+        for positions in postings[1:]:
+            if not matches:
+                break
+            if len(positions) > SEARCH_BISECT_RATIO * len(matches):
+                matches = [position for position in matches
+                           if (index := bisect_left(positions, position)) < len(positions)
+                           and positions[index] == position]
+            else:
+                candidates = set(matches)
+                matches = [position for position in positions if position in candidates]
+        return list(matches)
+
+
+search_index = SearchIndex()
+
+# Most requested videos, tracked with POPULAR_CAPACITY counters
+POPULAR_CAPACITY = 500
+POPULAR_SAVE_EVERY = 25
+
+
+class _CountBucket:
+    """All keys of a SpaceSaving sketch that share one count"""
+    __slots__ = ('count', 'keys', 'prev', 'next')
+
+    def __init__(self, count):
+        self.count = count
+        self.keys = {}  # Insertion-ordered set
+        self.prev = None
+        self.next = None
+
+
+class SpaceSaving:
+    """Streaming heavy hitters (Space-Saving over a stream-summary)
+
+    Keeps capacity counters. An untracked key takes over the counter of
+    the least counted key and inherits its count as the error bound, so
+    any key seen more than n / capacity times is guaranteed to be
+    tracked. Counters sit in buckets ordered by count, so an update is
+    O(1) and the top k is read in O(k).
+    """
+
+    def __init__(self, capacity=POPULAR_CAPACITY):
+        self.capacity = capacity
+        self.buckets = {}  # key -> its _CountBucket
+        self.errors = {}   # key -> overestimation bound
+        self.labels = {}   # key -> title shown in reports
+        self.head = None   # Lowest count
+        self.tail = None   # Highest count
+        self.updates = 0
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def record(self, key, label=None):
+        self.updates += 1
+        if label:
+            self.labels[key] = label
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            self._move(key, bucket, bucket.count + 1)
+        elif len(self.buckets) < self.capacity:
+            self._insert(key, 1, 0)
+        else:
+            # Evict the oldest key with the lowest count
+            victim = next(iter(self.head.keys))
+            count = self.head.count
+            self._remove(victim, self.head)
+            del self.buckets[victim], self.errors[victim]
+            self.labels.pop(victim, None)
+            self._insert(key, count + 1, count)
+
+    def _insert(self, key, count, error):
+        self.errors[key] = error
+        if self.head and self.head.count == count:
+            bucket = self.head
+        elif self.head and self.head.count < count:
+            # Eviction: count is head.count + 1, so this walks one bucket at most
+            bucket = self.head
+            while bucket.next and bucket.next.count <= count:
+                bucket = bucket.next
+            if bucket.count != count:
+                bucket = self._link_after(bucket, count)
+        else:
+            bucket = _CountBucket(count)
+            bucket.next = self.head
+            if self.head:
+                self.head.prev = bucket
+            else:
+                self.tail = bucket
+            self.head = bucket
+        bucket.keys[key] = None
+        self.buckets[key] = bucket
+
+    def _move(self, key, bucket, count):
+        target = bucket.next
+        if target is None or target.count != count:
+            target = self._link_after(bucket, count)
+        self._remove(key, bucket)
+        target.keys[key] = None
+        self.buckets[key] = target
+
+    def _link_after(self, bucket, count):
+        new_bucket = _CountBucket(count)
+        new_bucket.prev = bucket
+        new_bucket.next = bucket.next
+        if bucket.next:
+            bucket.next.prev = new_bucket
+        else:
+            self.tail = new_bucket
+        bucket.next = new_bucket
+        return new_bucket
+
+    def _remove(self, key, bucket):
+        del bucket.keys[key]
+        if bucket.keys:
+            return
+        if bucket.prev:
+            bucket.prev.next = bucket.next
+        else:
+            self.head = bucket.next
+        if bucket.next:
+            bucket.next.prev = bucket.prev
+        else:
+            self.tail = bucket.prev
+
+    def top(self, k):
+        """[(key, count, error)] of the k highest counts, highest first"""
+        result = []
+        bucket = self.tail
+        while bucket and len(result) < k:
+            for key in bucket.keys:
+                result.append((key, bucket.count, self.errors[key]))
+                if len(result) == k:
+                    break
+            bucket = bucket.prev
+        return result
+
+    def to_dict(self):
+        return {
+            'capacity': self.capacity,
+            'counters': [[key, count, error, self.labels.get(key)]
+                         for key, count, error in self.top(len(self.buckets))]
+        }
+
+    def load(self, data):
+        self.__init__(data.get('capacity', self.capacity))
+        # Lowest first, so every insert lands at or after the tail
+        for key, count, error, label in reversed(data.get('counters', [])):
+            if self.tail and self.tail.count == count:
+                bucket = self.tail
+            elif self.tail:
+                bucket = self._link_after(self.tail, count)
+            else:
+                bucket = self.head = self.tail = _CountBucket(count)
+            bucket.keys[key] = None
+            self.buckets[key] = bucket
+            self.errors[key] = error
+            if label:
+                self.labels[key] = label
+
+
+popular_videos = SpaceSaving()
+
+
+def record_popular(video_key, title=None):
+    """Count a request for video_key and persist the sketch now and then"""
+    popular_videos.record(video_key, title)
+    if popular_videos.updates % POPULAR_SAVE_EVERY == 0 and not data_files_frozen:
+        persistence.save_json(POPULAR_VIDEOS_FILE, popular_videos.to_dict())
+
+
+# Active users
+
+# One HyperLogLog sketch per stats day; sketches of several days merge into
+# the distinct users of the whole range. 2^HLL_PRECISION one-byte registers
+# give a standard error of about 1.04 / sqrt(2^HLL_PRECISION) (~3%).
+HLL_PRECISION = 10
+ACTIVE_USERS_KEEP_DAYS = 35
+
+
+class HyperLogLog:
+    """Approximate distinct counter in 2^precision bytes"""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers else bytearray(1 << precision)
+
+    def add(self, item):
+        """Add an item; returns True when the sketch changed"""
+        digest = hashlib.blake2b(str(item).encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'big')
+        width = 64 - self.precision
+        index = value >> width
+        rank = width - (value & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Estimated number of distinct items added"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Linear counting for small sets
+        return round(estimate)
+
+    def to_str(self):
+        return base64.b64encode(self.registers).decode()
+
+    @classmethod
+    def from_str(cls, data):
+        registers = base64.b64decode(data)
+        return cls(len(registers).bit_length() - 1, registers)
+
+
+class ActiveUsers:
+    """Per-day distinct user sketches for DAU/WAU/MAU
+
+    Exact per-user state is only kept for today's limits
+    (bot_data['users_today']); everything longer-range comes from these
+    sketches, which take a few KB however many users there are.
+    """
+
+    def __init__(self):
+        self.days = {}  # ISO date -> HyperLogLog
+        self.dirty = False
+
+    def record(self, user_id, day=None):
+        day = (day or current_stats_day()).isoformat()
+        sketch = self.days.get(day)
+        if sketch is None:
+            sketch = self.days[day] = HyperLogLog()
+            self.prune()
+        if sketch.add(user_id):
+            self.dirty = True
+
+    def count(self, days=1, end=None):
+        """Estimated distinct users over the days days ending at end (default today)"""
+        end = end or current_stats_day()
+        merged = HyperLogLog()
+        for offset in range(days):
+            sketch = self.days.get((end - timedelta(days=offset)).isoformat())
+            if sketch is not None:
+                merged.merge(sketch)
+        return merged.count()
+
+    def prune(self):
+        cutoff = (current_stats_day() - timedelta(days=ACTIVE_USERS_KEEP_DAYS)).isoformat()
+        for day in [day for day in self.days if day < cutoff]:
+            del self.days[day]
+
+    def to_dict(self):
+        return {day: sketch.to_str() for day, sketch in sorted(self.days.items())}
+
+    def load(self):
+        """Load the sketches, seeding them from the download history the first time"""
+        self.days = {}
+        if os.path.exists(ACTIVE_USERS_FILE):
+            for day, data in load_json_data(ACTIVE_USERS_FILE, {}).items():
+                self.days[day] = HyperLogLog.from_str(data)
+            return
+
+        # Before the sketches existed only downloads were dated, so the
+        # seeded days count downloading users
+        cutoff = (current_stats_day() - timedelta(days=ACTIVE_USERS_KEEP_DAYS)).isoformat()
+        for video in iter_download_records():
+            day = video.get('download_date', '')[:10]
+            if day >= cutoff and video.get('user_id') is not None:
+                if day not in self.days:
+                    self.days[day] = HyperLogLog()
+                self.days[day].add(video['user_id'])
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        if data_files_frozen:
+            return
+        if self.dirty or force:
+            self.dirty = False
+            persistence.save_json(ACTIVE_USERS_FILE, self.to_dict())
+
+
+active_users = ActiveUsers()
+
+# User data storage
+
+
+class UserProfile:
+    """Fixed-shape user profile; downloads live in the download log"""
+    __slots__ = ('user_id', 'first_name', 'last_name', 'username',
+                 'first_seen', 'last_seen', 'total_downloads')
+
+    def __init__(self, user_id, first_name='', last_name='', username='',
+                 first_seen='', last_seen='', total_downloads=0):
+        self.user_id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.total_downloads = total_downloads
+
+
+class UserStore:
+    """Hot/cold split of user data
+
+    Profiles are small and change on every interaction, so they live in
+    memory and are written as one compact table. A user's downloads are
+    only kept in the download log, indexed by admin_stats.videos_by_user.
+    """
+
+    def __init__(self):
+        self.profiles = {}  # user_key -> UserProfile
+        self.dirty = set()  # user_keys changed since the last flush
+
+    def load(self):
+        members = iter_json_container(USERS_DATA_FILE) if os.path.exists(USERS_DATA_FILE) else iter(())
+        first = next(members, None)
+        if first and first[0] == 'fields':
+            data = load_json_data(USERS_DATA_FILE, {})
+            for row in data['rows']:
+                profile = UserProfile(**dict(zip(data['fields'], row)))
+                self.profiles[str(profile.user_id)] = profile
+            return
+
+        # Old format, streamed: one dict per user with the history embedded.
+        # Every embedded entry was also written to the video list, which is
+        # now the download log, so the copy is dropped
+        dropped = 0
+        for user_key, user in itertools.chain([first] if first else [], members):
+            dropped += len(user.pop('videos_downloaded', []))
+            self.profiles[user_key] = UserProfile(
+                **{field: user[field] for field in UserProfile.__slots__ if field in user})
+        self.save_profiles()
+        if self.profiles:
+            logger.info(f"Converted {len(self.profiles)} user records into profiles, "
+                        f"dropping {dropped} history entries duplicated in the download log")
+
+    def table(self):
+        """The profile table as written to USERS_DATA_FILE"""
+        return {
+            'fields': UserProfile.__slots__,
+            'rows': list(map(attrgetter(*UserProfile.__slots__), self.profiles.values()))
+        }
+
+    def save_profiles(self):
+        """Rewrite the profile table (a few hundred bytes per user)"""
+        if data_files_frozen:
+            return
+        try:
+            temp_path = f"{USERS_DATA_FILE}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.table(), f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, USERS_DATA_FILE)
+        except Exception as e:
+            logger.error(f"Error saving {USERS_DATA_FILE}: {e}")
+
+    def flush(self):
+        """Write the profile table if any profile changed since the last flush"""
+        if not self.dirty:
+            return 0
+        count = len(self.dirty)
+        self.dirty.clear()
+        self.save_profiles()
+        return count
+
+
+user_store = UserStore()
+
+
+async def user_flush_scheduler():
+    """Write coalesced profile changes in batches"""
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        try:
+            user_store.flush()
+            active_users.flush()
+        except Exception as e:
+            logger.error(f"User flush error: {e}")
+
+
+def save_user_data(user_id, user_info, video_url=None):
+    """Update the user's profile
+
+    Changes only mark the profile dirty; user_flush_scheduler writes them
+    in batches. A new user's count is made durable by its WAL record.
+    """
+    user_key = str(user_id)
+    now = datetime.now()
+    current_time = now.isoformat(timespec='seconds')
+    active_users.record(user_id)
+
+    profile = user_store.profiles.get(user_key)
+    if profile is None:
+        profile = UserProfile(
+            user_id,
+            first_name=user_info.get('first_name', ''),
+            last_name=user_info.get('last_name', ''),
+            username=user_info.get('username', ''),
+            first_seen=current_time,
+            last_seen=current_time
+        )
+        user_store.profiles[user_key] = profile
+        user_store.dirty.add(user_key)
+        # Update total users count
+        limits.log({'op': 'new_user'})
+        admin_stats.record_user()
+        admin_stats.users_by_last_seen.update(user_key, current_time)
+        return
+
+    # Update last seen, at LAST_SEEN_GRANULARITY resolution
+    last_seen = datetime.fromisoformat(profile.last_seen) if profile.last_seen else None
+    if last_seen is None or (now - last_seen).total_seconds() >= LAST_SEEN_GRANULARITY:
+        profile.last_seen = current_time
+        admin_stats.users_by_last_seen.update(user_key, current_time)
+        user_store.dirty.add(user_key)
+
+    # Update user info in case it changed
+    names = (user_info.get('first_name', ''), user_info.get('last_name', ''),
+             user_info.get('username', ''))
+    if names != (profile.first_name, profile.last_name, profile.username):
+        profile.first_name, profile.last_name, profile.username = names
+        user_store.dirty.add(user_key)
+
+    if video_url:
+        profile.total_downloads += 1
+        user_store.dirty.add(user_key)
+
+
+# Downloads that finish while the data files are being swapped wait here
+# (a list instead of None) and are stored once the new files are loaded
+held_video_records = None
+
+
+def save_video_data(user_id, video_info):
+    """Append the download to the download log"""
+    video_record = {
+        'user_id': user_id,
+        'video_url': video_info.get('url', ''),
+        'video_title': video_info.get('title', ''),
+        'duration': video_info.get('duration', 0),
+        'format': video_info.get('format', ''),
+        'file_size': video_info.get('file_size', 0),
+        'download_date': datetime.now().isoformat(),
+        'success': video_info.get('success', True)
+    }
+
+    if video_info.get('ie_key'):
+        record_popular(canonical_url(video_record['video_url'], video_info['ie_key']),
+                       video_record['video_title'])
+    if held_video_records is not None:
+        held_video_records.append(video_record)
+        return
+    store_video_record(video_record)
+
+
+def store_video_record(video_record):
+    """Append a record to the download log and every index over it"""
+    position = download_log.append(video_record)
+    analytics.append(video_record)
+    search_index.add(position, video_record)
+    admin_stats.record_video(video_record)
+    admin_stats.save()
+    admin_stats.videos_by_date.update(position, video_record['download_date'])
+    admin_stats.videos_by_user.setdefault(str(video_record['user_id']), []).append(position)
+
+
+def release_held_video_records():
+    """Store the downloads held during a swap of the data files"""
+    global held_video_records
+    records, held_video_records = held_video_records or [], None
+    for video_record in records:
+        store_video_record(video_record)
+    return len(records)
+
+
+# Supported site index
+
+
+class SupportedSiteIndex:
+    """Route URLs to yt-dlp extractors by hostname instead of trying them all"""
+
+    # Host labels that say nothing about the site
+    IGNORED_LABELS = {'www', 'm', 'mobile', 'com', 'net', 'org'}
+    # Hosts where not even the generic extractor found a video, remembered
+    # for UNSUPPORTED_HOST_TTL seconds (also the size of the Generic-only
+    # host memo)
+    MAX_UNSUPPORTED_HOSTS = 10000
+    UNSUPPORTED_HOST_TTL = 6 * 60 * 60
+
+    def __init__(self):
+        self.ie_keys = []     # Extractor keys in yt-dlp's own priority order
+        self.labels = {}      # Host label -> sorted list of positions in ie_keys
+        self.version = None
+        self.unsupported_hosts = OrderedDict()  # Host key -> expiry time, oldest first
+        self.generic_hosts = OrderedDict()      # Host keys only Generic handles
+        self.lock = Lock()    # match() runs on probe_executor threads
+
+    def load_or_build(self):
+        """Load the index from disk, rebuilding it if yt-dlp was upgraded"""
+        cached = load_json_data(EXTRACTOR_INDEX_FILE, {})
+        if cached.get('yt_dlp_version') == yt_dlp.version.__version__:
+            self.ie_keys = cached['ie_keys']
+            self.labels = cached['labels']
+            self.version = cached['yt_dlp_version']
+            logger.info(f"Loaded extractor index ({len(self.ie_keys)} extractors)")
+            return
+
+        start = time.time()
+        self.build()
+        self.save()
+        logger.info(f"Built extractor index ({len(self.ie_keys)} extractors, "
+                    f"{len(self.labels)} labels) in {time.time() - start:.2f}s")
+
+    def build(self):
+        """Index every extractor under the words that appear in its URL regex"""
+        self.ie_keys = []
+        self.labels = {}
+        self.unsupported_hosts.clear()
+        self.generic_hosts.clear()
+
+        for ie in gen_extractor_classes():
+            if ie.ie_key() == 'Generic':
+                continue  # Matches everything; never worth routing to
+            position = len(self.ie_keys)
+            self.ie_keys.append(ie.ie_key())
+            for word in self._regex_words(ie._VALID_URL):
+                self.labels.setdefault(word, []).append(position)
+
+        self.version = yt_dlp.version.__version__
+
+    def save(self):
+        """Persist the index so later startups skip the build"""
+        save_json_data(EXTRACTOR_INDEX_FILE, {
+            'yt_dlp_version': self.version,
+            'ie_keys': self.ie_keys,
+            'labels': self.labels
+        })
+
+    @staticmethod
+    def _regex_words(valid_url):
+        """Collect the literal words of a _VALID_URL pattern (or patterns)"""
+        words = set()
+        if not valid_url or not isinstance(valid_url, (str, tuple, list)):
+            return words
+
+        for pattern in variadic(valid_url):
+            # Drop escapes such as \d or \w and named group headers
+            pattern = re.sub(r'\\[a-zA-Z]|\(\?P<\w+>', ' ', pattern)
+            for match in re.finditer(r'[a-z0-9][a-z0-9-]*', pattern, re.IGNORECASE):
+                word = match.group().lower()
+                words.add(word)
+                # "tiktokv?" must also match plain "tiktok"
+                if pattern[match.end():match.end() + 1] == '?':
+                    words.add(word[:-1])
+        return words
+
+    @staticmethod
+    def _host_labels(url):
+        """Split the URL's hostname into labels, ignoring the TLD"""
+        if '://' not in url:
+            url = f"http://{url}"
+        try:
+            host = urlparse(url).hostname or ''
+        except ValueError:
+            return []
+        return [label for label in host.split('.')[:-1]
+                if label not in SupportedSiteIndex.IGNORED_LABELS]
+
+    def known_unsupported(self, url):
+        """True if url's host recently failed even the generic extractor (safe on the loop)"""
+        expires_at = self.unsupported_hosts.get('.'.join(self._host_labels(url)))
+        return expires_at is not None and expires_at > time.time()
+
+    def mark_unsupported(self, url):
+        """Remember that the generic extractor found nothing at url's host
+
+        Only hosts no extractor regex mentions are remembered; a known site
+        can still reject one of its URLs and accept the next.
+        """
+        labels = self._host_labels(url)
+        if any(label in self.labels for label in labels):
+            return
+        with self.lock:
+            host_key = '.'.join(labels)
+            self.unsupported_hosts.pop(host_key, None)
+            self.unsupported_hosts[host_key] = time.time() + self.UNSUPPORTED_HOST_TTL
+            while len(self.unsupported_hosts) > self.MAX_UNSUPPORTED_HOSTS:
+                self.unsupported_hosts.popitem(last=False)
+
+    def match(self, url):
+        """Return the key of the extractor that handles url
+
+        'Generic' when no dedicated extractor does: it follows redirects
+        (shorteners, share links such as fb.watch) and finds direct media.
+        Blocking (regex matching, and a full scan for unknown hosts), so
+        run it on probe_executor.
+        """
+        if not self.ie_keys:
+            self.load_or_build()
+
+        labels = self._host_labels(url)
+        host_key = '.'.join(labels)
+        if host_key in self.generic_hosts:
+            return 'Generic'
+
+        candidates = sorted({position for label in labels
+                             for position in self.labels.get(label, ())})
+        for position in candidates:
+            if get_info_extractor(self.ie_keys[position]).suitable(url):
+                return self.ie_keys[position]
+
+        # The hostname was not spelled out in any regex; fall back to
+        # trying everything and remember the answer for next time
+        for position, ie_key in enumerate(self.ie_keys):
+            if get_info_extractor(ie_key).suitable(url):
+                if labels:
+                    with self.lock:
+                        # Swap in a new list; readers on other threads may
+                        # be walking the old one
+                        self.labels[labels[-1]] = sorted(
+                            {*self.labels.get(labels[-1], ()), position})
+                        self.save()
+                return ie_key
+
+        # Skip the full scan next time for hosts no regex mentions
+        if not candidates:
+            with self.lock:
+                self.generic_hosts[host_key] = None
+                while len(self.generic_hosts) > self.MAX_UNSUPPORTED_HOSTS:
+                    self.generic_hosts.popitem(last=False)
+        return 'Generic'
+
+
+site_index = SupportedSiteIndex()
+
+
+def canonical_url(url, ie_key):
+    """Reduce a URL to a stable key such as Youtube:dQw4w9WgXcQ"""
+    try:
+        video_id = get_info_extractor(ie_key).get_temp_id(url)
+    except Exception:
+        video_id = None
+    if video_id:
+        return f"{ie_key}:{video_id}"
+
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').removeprefix('www.')
+    query = f"?{parsed.query}" if parsed.query else ''
+    return f"{ie_key}:{host}{parsed.path.rstrip('/')}{query}"
 
-            # Update user's daily download count
-            user_key = str(user_id)
-            self.bot_data['user_downloads_today'][user_key] = self.bot_data['user_downloads_today'].get(
-                user_key, 0) + 1
 
-            # Save updated data
-            save_json_data(BOT_DATA_FILE, self.bot_data)
+# Negative cache for URLs that failed to process
 
-    def get_stats(self):
-        """Get current bot statistics"""
-        self.reset_daily_stats_if_needed()
-        return {
-            'active_downloads': len(self.active_downloads),
-            'daily_downloads': self.bot_data['total_downloads_today'],
-            'users_today': len(self.bot_data['users_today']),
-            'remaining_downloads': self.max_total_daily_downloads - self.bot_data['total_downloads_today'],
-            'total_downloads_all_time': self.bot_data['total_downloads_all_time'],
-            'total_users': self.bot_data['total_users'],
-            'bot_start_date': self.bot_data['bot_start_date']
+
+class NegativeCache:
+    """Remember failed probes so repeats are answered without yt-dlp"""
+
+    # Base TTL in seconds per error class; doubles on every repeated failure
+    BASE_TTLS = {
+        'private': 30 * 60,
+        'geo_blocked': 60 * 60,
+        'removed': 6 * 60 * 60,
+        'unsupported': 6 * 60 * 60,
+        'error': 60
+    }
+    MAX_TTL = 7 * 24 * 60 * 60
+    MAX_ENTRIES = 10000
+
+    MESSAGES = {
+        'private': "🔒 This video is private. Please send a public video URL.",
+        'geo_blocked': "🌍 This video is not available in the bot's region.",
+        'removed': "🗑️ This video has been removed or is no longer available.",
+        'unsupported': "❌ This link is not from a supported site. Please send a video URL.",
+        'error': "❌ Unable to process this video. Please try a different URL."
+    }
+
+    def __init__(self):
+        self.entries = {}  # Canonical URL -> failure record
+
+    @staticmethod
+    def classify(error):
+        """Map a yt-dlp exception to one of the cached error classes"""
+        if isinstance(error, DownloadError) and error.exc_info:
+            error = error.exc_info[1] or error
+
+        if isinstance(error, GeoRestrictedError):
+            return 'geo_blocked'
+        if isinstance(error, UnsupportedError):
+            return 'unsupported'
+
+        text = str(error).lower()
+        if 'private' in text or 'sign in' in text or 'login' in text:
+            return 'private'
+        if 'country' in text or 'geo' in text or 'region' in text:
+            return 'geo_blocked'
+        if any(word in text for word in ('removed', 'deleted', 'terminated',
+                                         'no longer available', 'does not exist',
+                                         'unavailable')):
+            return 'removed'
+        return 'error'
+
+    def get(self, key):
+        """Return the cached failure for key if it has not expired"""
+        entry = self.entries.get(key)
+        if entry and entry['expires_at'] > time.time():
+            return entry
+        return None
+
+    def record_failure(self, key, error):
+        """Cache a failure, growing its TTL if the URL keeps failing"""
+        error_class = self.classify(error)
+        entry = self.entries.pop(key, None)
+        failures = entry['failures'] + 1 if entry else 1
+        ttl = min(self.BASE_TTLS[error_class] * 2 ** (failures - 1), self.MAX_TTL)
+
+        if len(self.entries) >= self.MAX_ENTRIES:
+            self.purge()
+
+        # Re-inserted so the dict stays ordered by last failure
+        self.entries[key] = {
+            'error_class': error_class,
+            'message': self.MESSAGES[error_class],
+            'failures': failures,
+            'expires_at': time.time() + ttl
         }
+        return self.entries[key]
+
+    def record_success(self, key):
+        """Forget a URL once it processes fine again"""
+        self.entries.pop(key, None)
+
+    def purge(self):
+        """Drop expired entries, then the oldest ones if still full"""
+        now = time.time()
+        for key in [k for k, v in self.entries.items() if v['expires_at'] <= now]:
+            del self.entries[key]
+        while len(self.entries) >= self.MAX_ENTRIES:
+            del self.entries[next(iter(self.entries))]
+
+
+negative_cache = NegativeCache()
+
+# Thread pool for yt-dlp probes so extraction never blocks the event loop
+PROBE_WORKERS = 4
+probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS,
+                                    thread_name_prefix="probe")
+
+
+# Tiered video probing
+
+# First tier: only what the "Video Found" reply needs. Format selection,
+# DASH/HLS manifests and the player JS are skipped; the full resolution
+# happens once, inside the download thread, when the user taps a quality.
+FAST_PROBE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+    'extract_flat': 'in_playlist',
+    'ignore_no_formats_error': True,
+    'extractor_args': {
+        'youtube': {
+            'skip': ['dash', 'hls', 'translated_subs'],
+            'player_skip': ['js']
+        }
+    }
+}
 
+# The probe handle_url used before the tiers, kept for /adminbenchprobe
+FULL_PROBE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': False,
+    'skip_download': True
+}
 
-# Initialize limits manager
-limits = BotLimits()
 
-# User data storage
+def fast_probe(url, ie_key):
+    """Fetch title and duration without resolving formats"""
+    with yt_dlp.YoutubeDL(FAST_PROBE_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False, ie_key=ie_key, process=False)
 
+        # Unprocessed results may just point at another extractor (youtu.be)
+        for _ in range(3):
+            if info.get('_type') not in ('url', 'url_transparent'):
+                break
+            target = ydl.extract_info(info['url'], download=False,
+                                      ie_key=info.get('ie_key'), process=False)
+            if info['_type'] == 'url_transparent':
+                overrides = {k: v for k, v in info.items()
+                             if k not in ('_type', 'url', 'ie_key') and v is not None}
+                target = {**target, **overrides}
+            info = target
+        return info
 
-def save_user_data(user_id, user_info, video_url=None):
-    """Save user data to JSON file"""
-    users_data = load_json_data(USERS_DATA_FILE, {})
 
-    user_key = str(user_id)
-    current_time = datetime.now().isoformat()
+def full_probe(url, ie_key):
+    """Resolve every format, as the original single-tier probe did"""
+    with yt_dlp.YoutubeDL(FULL_PROBE_OPTS) as ydl:
+        return ydl.extract_info(url, download=False, ie_key=ie_key)
 
-    if user_key not in users_data:
-        users_data[user_key] = {
-            'user_id': user_id,
-            'first_name': user_info.get('first_name', ''),
-            'last_name': user_info.get('last_name', ''),
-            'username': user_info.get('username', ''),
-            'first_seen': current_time,
-            'last_seen': current_time,
-            'total_downloads': 0,
-            'videos_downloaded': []
-        }
-        # Update total users count
-        limits.bot_data['total_users'] += 1
-        save_json_data(BOT_DATA_FILE, limits.bot_data)
-    else:
-        # Update last seen
-        users_data[user_key]['last_seen'] = current_time
-        # Update user info in case it changed
-        users_data[user_key]['first_name'] = user_info.get('first_name', '')
-        users_data[user_key]['last_name'] = user_info.get('last_name', '')
-        users_data[user_key]['username'] = user_info.get('username', '')
 
-    if video_url:
-        users_data[user_key]['total_downloads'] += 1
+# Playlists
 
-    save_json_data(USERS_DATA_FILE, users_data)
+PLAYLIST_PAGE_SIZE = 8
+MAX_PLAYLIST_SELECTION = 25
 
 
-def save_video_data(user_id, video_info):
-    """Save video download data to JSON file"""
-    videos_data = load_json_data(VIDEOS_DATA_FILE, [])
+class PlaylistCursor:
+    """Walk playlist entries lazily, one keyboard page at a time"""
 
-    video_record = {
-        'user_id': user_id,
-        'video_url': video_info.get('url', ''),
-        'video_title': video_info.get('title', ''),
-        'duration': video_info.get('duration', 0),
-        'format': video_info.get('format', ''),
-        'file_size': video_info.get('file_size', 0),
-        'download_date': datetime.now().isoformat(),
-        'success': video_info.get('success', True)
-    }
+    def __init__(self, entries):
+        self.entries = iter(entries)  # Generator/LazyList from the flat probe
+        self.seen = []                # Compact entries fetched so far
+        self.exhausted = False
+        self.lock = Lock()            # Pages are fetched on probe threads
 
-    videos_data.append(video_record)
-    save_json_data(VIDEOS_DATA_FILE, videos_data)
+    def fetch_page(self, page):
+        """Return the entries of page and whether another page follows"""
+        start = page * PLAYLIST_PAGE_SIZE
+        end = start + PLAYLIST_PAGE_SIZE
 
-    # Also update user's video list
-    users_data = load_json_data(USERS_DATA_FILE, {})
-    user_key = str(user_id)
-    if user_key in users_data:
-        users_data[user_key]['videos_downloaded'].append({
-            'title': video_info.get('title', ''),
-            'url': video_info.get('url', ''),
-            'date': datetime.now().isoformat()
-        })
-        save_json_data(USERS_DATA_FILE, users_data)
+        with self.lock:
+            # One entry past the page tells us whether there is a next page
+            while len(self.seen) <= end and not self.exhausted:
+                try:
+                    entry = next(self.entries)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                if not entry:
+                    continue
+                self.seen.append({
+                    'title': entry.get('title') or 'Unknown',
+                    'duration': int(entry.get('duration') or 0),
+                    'url': entry.get('webpage_url') or entry.get('url'),
+                    'ie_key': entry.get('ie_key') or entry.get('extractor_key')
+                })
+
+        return self.seen[start:end], len(self.seen) > end
 
 
 # User data storage (kept minimal for active sessions)
@@ -290,14 +2516,14 @@ async def start_command(client: Client, message: Message):
 👋 **Welcome to the your number one Youtube video Downloader Bot!**
 
 ⚠️ **Daily Limits:**
-• Maximum {limits.max_videos_per_user} videos per user a day
+• Maximum {limits.max_videos_per_user} videos per user every 24 hours
 
 📱 **How to use:**
 • send a video URL from Youtube.
 • Choose video quality from the options
 • Wait for download and upload
 
-🔄 **Limits reset daily at midnight UTC**
+🔄 **Limits refill gradually over a rolling 24 hours**
 
 use /help for more information and useful.
     """
@@ -311,23 +2537,202 @@ async def stats_command(client: Client, message: Message):
     stats = limits.get_stats()
     user_id = message.from_user.id
 
-    limits.reset_daily_stats_if_needed()
-    user_downloads_today = limits.bot_data['user_downloads_today'].get(
-        str(user_id), 0)
+    remaining = limits.remaining_for(user_id)
 
     stats_text = f"""
 👤 **Your Status:**
-• Your downloads today: {user_downloads_today}/{limits.max_videos_per_user}
+• Downloads available now: {remaining}/{limits.max_videos_per_user}
+• Data available: {format_bytes(max(0, limits.user_byte_buckets.available(user_id)))}/{format_bytes(limits.max_bytes_per_user)}
+• Video time available: {max(0, int(limits.user_second_buckets.available(user_id))) // 60}/{limits.max_seconds_per_user // 60} min
 • Can you download: {"✅ Yes" if limits.can_user_download(user_id)[0] else "❌ No"}
 
 📋 **Daily Limits:**
-• Max videos per user: {limits.max_videos_per_user}  
+• Max videos per user: {limits.max_videos_per_user} per 24 hours
 
-🕐 **Resets:** Daily at midnight UTC
+🕐 **Refills:** Gradually over a rolling 24 hours
     """
 
     await message.reply_text(stats_text)
 
+# Backups
+
+# Each backup is a manifest listing the content hashes of fixed-size
+# segments of every data file. Segments are stored once, lzma-compressed,
+# under their hash, so a backup only writes what changed since the last one
+# (for the append-only history that is just the tail).
+BACKUP_DIR = "backups"
+BACKUP_OBJECTS_DIR = os.path.join(BACKUP_DIR, "objects")
+BACKUP_SEGMENT_SIZE = 1024 * 1024
+BACKUP_KEEP = 5
+BACKUP_FILES = [USERS_DATA_FILE, DOWNLOAD_LOG_FILE,
+                BOT_DATA_FILE, ADMIN_STATS_FILE, DAILY_STATS_FILE, POPULAR_VIDEOS_FILE,
+                ACTIVE_USERS_FILE]
+
+# Held by backup, restore, pruning and import: a backup that deduplicated
+# against an existing segment must write its manifest before pruning can
+# see it, and only one command at a time may swap the data files
+backup_lock = asyncio.Lock()
+
+
+def store_backup_segment(data):
+    """Store a segment under its hash -> (digest, bytes written)"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(BACKUP_OBJECTS_DIR, f"{digest}.xz")
+    if os.path.exists(path):
+        return digest, 0
+
+    temp_path = f"{path}.tmp"
+    with lzma.open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return digest, os.path.getsize(path)
+
+
+def capture_snapshot():
+    """Capture every store at one logical instant (call on the event loop)
+
+    All writers run on the event loop, so nothing changes while this runs.
+    In-memory stores are copied. Files on disk are pinned with a hardlink,
+    which keeps the current version alive when save_json_data swaps in a
+    new one; the append-only download log is pinned by its current length.
+    Reading and compressing all of it happens later, in a thread.
+    """
+    started = time.perf_counter()
+    snapshot = {
+        'time': datetime.now().isoformat(),
+        'memory': {
+            USERS_DATA_FILE: user_store.table(),
+            BOT_DATA_FILE: limits.state_snapshot(),
+            ADMIN_STATS_FILE: admin_stats.to_dict(),
+            POPULAR_VIDEOS_FILE: popular_videos.to_dict(),
+            ACTIVE_USERS_FILE: active_users.to_dict()
+        },
+        'files': {},
+        'staging_dir': os.path.join(BACKUP_DIR, f"staging_{time.time_ns()}")
+    }
+
+    os.makedirs(snapshot['staging_dir'], exist_ok=True)
+    for filename in BACKUP_FILES:
+        if filename in snapshot['memory'] or not os.path.exists(filename):
+            continue
+        pinned = os.path.join(snapshot['staging_dir'], os.path.basename(filename))
+        try:
+            os.link(filename, pinned)
+        except OSError:
+            shutil.copyfile(filename, pinned)  # No hardlinks on this filesystem
+        snapshot['files'][filename] = (pinned, os.path.getsize(pinned))
+
+    snapshot['capture_ms'] = (time.perf_counter() - started) * 1000
+    return snapshot
+
+
+def snapshot_segments(snapshot, filename):
+    """Yield the snapshot's content of filename in BACKUP_SEGMENT_SIZE pieces"""
+    if filename in snapshot['memory']:
+        data = json.dumps(snapshot['memory'][filename], indent=2,
+                          ensure_ascii=False, default=str).encode('utf-8')
+        for start in range(0, len(data), BACKUP_SEGMENT_SIZE):
+            yield data[start:start + BACKUP_SEGMENT_SIZE]
+        return
+
+    pinned, remaining = snapshot['files'][filename]
+    with open(pinned, 'rb') as f:
+        while remaining > 0:
+            data = f.read(min(BACKUP_SEGMENT_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def create_backup(snapshot, bot_stats):
+    """Write an incremental backup of a snapshot (blocking, run in a thread)"""
+    os.makedirs(BACKUP_OBJECTS_DIR, exist_ok=True)
+    backup_name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    suffix = 1
+    while os.path.exists(os.path.join(BACKUP_DIR, f"{backup_name}.json")):
+        backup_name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{suffix}"
+        suffix += 1
+    manifest = {
+        'backup_time': datetime.now().isoformat(),
+        'snapshot_time': snapshot['time'],
+        'files': {},
+        'bot_stats': bot_stats
+    }
+
+    total_bytes = written_bytes = 0
+    try:
+        for filename in BACKUP_FILES:
+            if filename not in snapshot['memory'] and filename not in snapshot['files']:
+                continue
+            segments = []
+            size = 0
+            for data in snapshot_segments(snapshot, filename):
+                digest, written = store_backup_segment(data)
+                segments.append(digest)
+                size += len(data)
+                written_bytes += written
+            manifest['files'][filename] = {'size': size, 'segments': segments}
+            total_bytes += size
+    finally:
+        shutil.rmtree(snapshot['staging_dir'], ignore_errors=True)
+
+    save_json_data(os.path.join(BACKUP_DIR, f"{backup_name}.json"), manifest)
+    return backup_name, len(manifest['files']), total_bytes, written_bytes
+
+
+def list_backups():
+    """Backup names, oldest first"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(name[:-5] for name in os.listdir(BACKUP_DIR)
+                  if name.startswith('backup_') and name.endswith('.json'))
+
+
+def restore_backup(backup_name):
+    """Rebuild the data files from a backup (blocking, run in a thread)"""
+    manifest = load_json_data(os.path.join(BACKUP_DIR, f"{backup_name}.json"), None)
+    if manifest is None:
+        raise FileNotFoundError(f"Backup {backup_name} not found")
+
+    restored = []
+    for filename, entry in manifest['files'].items():
+        if filename not in BACKUP_FILES:
+            continue  # A file older backups kept and the bot no longer uses
+        temp_path = f"{filename}.restore"
+        with open(temp_path, 'wb') as out:
+            for digest in entry['segments']:
+                with lzma.open(os.path.join(BACKUP_OBJECTS_DIR, f"{digest}.xz"), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        if os.path.getsize(temp_path) != entry['size']:
+            os.remove(temp_path)
+            raise ValueError(f"Restored {filename} has the wrong size")
+        os.replace(temp_path, filename)
+        restored.append(filename)
+    return restored
+
+
+def prune_backups(keep=BACKUP_KEEP):
+    """Drop all but the newest backups and the segments only they used"""
+    removed = 0
+    backups = list_backups()
+    for backup_name in backups[:-keep]:
+        os.remove(os.path.join(BACKUP_DIR, f"{backup_name}.json"))
+        removed += 1
+
+    referenced = set()
+    for backup_name in backups[-keep:]:
+        manifest = load_json_data(os.path.join(BACKUP_DIR, f"{backup_name}.json"))
+        for entry in manifest.get('files', {}).values():
+            referenced.update(entry['segments'])
+
+    if os.path.isdir(BACKUP_OBJECTS_DIR):
+        for name in os.listdir(BACKUP_OBJECTS_DIR):
+            if name.split('.')[0] not in referenced:
+                os.remove(os.path.join(BACKUP_OBJECTS_DIR, name))
+                removed += 1
+    return removed
+
 # Admin-only commands
 
 
@@ -335,38 +2740,43 @@ async def stats_command(client: Client, message: Message):
 async def admin_stats_command(client: Client, message: Message):
     """Show detailed admin statistics"""
     stats = limits.get_stats()
-    users_data = load_json_data(USERS_DATA_FILE, {})
-    videos_data = load_json_data(VIDEOS_DATA_FILE, [])
 
-    # Calculate additional stats
-    total_users = len(users_data)
-    total_videos = len(videos_data)
     active_users_today = len(limits.bot_data['users_today'])
-
-    # Recent downloads (last 10)
-    recent_videos = sorted(videos_data, key=lambda x: x.get(
-        'download_date', ''), reverse=True)[:10]
+    recent_videos = admin_stats.latest(5)
+    top_formats = sorted(admin_stats.formats.items(), key=lambda x: -x[1])[:3]
 
     admin_stats_text = f"""
 🔧 **ADMIN STATISTICS**
 
 📊 **Overall Stats:**
-• Total Users: {total_users}
+• Total Users: {admin_stats.total_users}
 • Bot Running Since: {stats['bot_start_date']}
 • All-time Downloads: {stats['total_downloads_all_time']}
+• Recorded Videos: {admin_stats.total_videos} ({admin_stats.failed_videos} failed, {format_bytes(admin_stats.total_bytes)})
+• Recorded Today: {admin_stats.per_day.get(current_stats_day().isoformat(), 0)}
+• Top Formats: {", ".join(f"{code} {count}" for code, count in top_formats) or "None"}
 
-📅 **Today's Stats:**
+📅 **Today's Stats** (resets {RESET_HOUR:02d}:00 {RESET_TIMEZONE.key}):
 • Active downloads: {stats['active_downloads']}/{limits.max_concurrent_downloads}
 • Downloads today: {stats['daily_downloads']}/{limits.max_total_daily_downloads}
 • Users today: {active_users_today}/{limits.max_users_per_day}
 • Remaining: {stats['remaining_downloads']}
 
+⏱️ **Rolling 24h (enforced):**
+• Downloads: {stats['rolling_downloads']}/{limits.max_total_daily_downloads}
+• Users: {stats['rolling_users']}/{limits.max_users_per_day}
+• Data: {format_bytes(stats['rolling_bytes'])}/{format_bytes(limits.max_total_daily_bytes)}
+• Video time: {stats['rolling_seconds'] // 60}/{limits.max_total_daily_seconds // 60} min
+
+👥 **Active Users** (approx.):
+• Today: {active_users.count(1)} | 7 days: {active_users.count(7)} | 30 days: {active_users.count(30)}
+
 📈 **Recent Activity:**
     """
 
     if recent_videos:
         admin_stats_text += "\n🎥 **Last 5 Downloads:**\n"
-        for i, video in enumerate(recent_videos[:5], 1):
+        for i, video in enumerate(recent_videos, 1):
             user_id = video.get('user_id', 'Unknown')
             title = video.get('video_title', 'Unknown')[:30]
             date = video.get('download_date', '')[:10]  # Just date part
@@ -375,96 +2785,348 @@ async def admin_stats_command(client: Client, message: Message):
     await message.reply_text(admin_stats_text)
 
 
+@app.on_message(filters.command("admintrend") & filters.user(ADMIN_USER_IDS))
+async def admin_trend_command(client: Client, message: Message):
+    """Show per-day trends from the daily rollups"""
+    days = 30
+    if len(message.command) > 1 and message.command[1].isdigit():
+        days = max(1, min(int(message.command[1]), 366))
+
+    daily_stats = load_json_data(DAILY_STATS_FILE, {})
+    daily_stats[limits.bot_data['last_reset_date']] = limits.today_rollup()
+    rows = sorted(daily_stats.items())[-days:]
+
+    total_downloads = sum(day['downloads'] for _, day in rows)
+    total_bytes = sum(day.get('bytes', 0) for _, day in rows)
+    total_failures = sum(day.get('failures', 0) for _, day in rows)
+    formats = {}
+    for _, day in rows:
+        for format_code, count in day.get('formats', {}).items():
+            formats[format_code] = formats.get(format_code, 0) + count
+
+    trend_text = (
+        f"📈 **TREND (last {len(rows)} days)**\n\n"
+        f"• Downloads: {total_downloads} (avg {total_downloads / max(len(rows), 1):.1f}/day)\n"
+        f"• Data: {format_bytes(total_bytes)}\n"
+        f"• Failures: {total_failures}\n"
+        f"• Peak daily users: {max((day['users'] for _, day in rows), default=0)}\n"
+    )
+    if formats:
+        trend_text += "• Formats: " + ", ".join(
+            f"{code} {count}" for code, count in sorted(formats.items(), key=lambda x: -x[1])) + "\n"
+
+    trend_text += "\n📅 **Per Day:**\n"
+    for date, day in rows[-15:]:
+        trend_text += (f"{date}: {day['downloads']} downloads, {day['users']} users, "
+                       f"{format_bytes(day.get('bytes', 0))}, {day.get('failures', 0)} failed\n")
+
+    await message.reply_text(trend_text)
+
+
+def admin_page_markup(prefix, entries, has_older, has_newer):
+    """Newer/Older buttons carrying the first and last shown index entry as cursors"""
+    buttons = []
+    if has_newer:
+        key, item_id = entries[0]
+        buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"{prefix}_n_{key}_{item_id}"))
+    if has_older:
+        key, item_id = entries[-1]
+        buttons.append(InlineKeyboardButton("Older ➡️", callback_data=f"{prefix}_o_{key}_{item_id}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def render_users_page(cursor=None, older=True):
+    """One page of users, most recently seen first"""
+    index = admin_stats.users_by_last_seen
+    entries, has_older, has_newer = index.page(cursor, older)
+
+    users_text = f"👥 **USER LIST** ({len(index)} users)\n\n"
+    for last_seen, user_id in entries:
+        profile = user_store.profiles[user_id]
+        name = profile.first_name or 'Unknown'
+        if profile.last_name:
+            name += f" {profile.last_name}"
+
+        username = profile.username or 'No username'
+        downloads = profile.total_downloads
+
+        users_text += f"• **{name}** (@{username})\n"
+        users_text += f"   ID: `{user_id}` | Downloads: {downloads} | Last: {last_seen[:10]}\n\n"
+
+    return users_text, admin_page_markup("au", entries, has_older, has_newer)
+
+
+def render_videos_page(cursor=None, older=True):
+    """One page of video downloads, most recent first"""
+    index = admin_stats.videos_by_date
+    entries, has_older, has_newer = index.page(cursor, older)
+    videos = download_log.read([position for _, position in entries])
+
+    videos_text = f"🎥 **RECENT DOWNLOADS** ({len(index)} videos)\n\n"
+    for video in videos:
+        title = video.get('video_title', 'Unknown')[:40]
+        user_id = video.get('user_id', 'Unknown')
+        date = video.get('download_date', '')[:16]  # Date and time
+        format_info = video.get('format', 'Unknown')
+        file_size = video.get('file_size', 0)
+        size_mb = f"{file_size/1024/1024:.1f}MB" if file_size > 0 else "Unknown"
+
+        videos_text += f"• **{title}**\n"
+        videos_text += f"   User: {user_id} | {date}\n"
+        videos_text += f"   Format: {format_info} | Size: {size_mb}\n\n"
+
+    return videos_text, admin_page_markup("av", entries, has_older, has_newer)
+
+
+@app.on_message(filters.command("admintop") & filters.user(ADMIN_USER_IDS))
+async def admin_top_command(client: Client, message: Message):
+    """Top users, formats and busiest hours from the columnar history"""
+    days = 7
+    if len(message.command) > 1 and message.command[1].isdigit():
+        days = max(1, min(int(message.command[1]), 3650))
+    since = time.time() - days * DAY_SECONDS
+
+    downloads, failures, total_bytes, total_seconds = analytics.totals(since)
+    if not downloads:
+        await message.reply_text(f"🏆 **No downloads in the last {days} days**")
+        return
+
+    top_text = (
+        f"🏆 **TOP (last {days} days)**\n\n"
+        f"• Downloads: {downloads} ({failures} failed)\n"
+        f"• Data: {format_bytes(total_bytes)}\n"
+        f"• Video time: {int(total_seconds) // 60} min\n"
+    )
+
+    top_text += "\n👥 **Top Users:**\n"
+    for i, (user_id, count, data) in enumerate(analytics.top_users(since), 1):
+        profile = user_store.profiles.get(str(user_id))
+        name = profile.first_name if profile and profile.first_name else user_id
+        top_text += f"{i}. {name} (`{user_id}`): {count} downloads, {format_bytes(data)}\n"
+
+    top_text += "\n🎞️ **Formats:**\n"
+    for format_name, count in analytics.format_counts(since)[:5]:
+        top_text += f"• {format_name}: {count} ({count * 100 / downloads:.0f}%)\n"
+
+    hours = analytics.hour_histogram(since)
+    peak = max(hours)
+    top_text += f"\n🕐 **Downloads by hour** ({RESET_TIMEZONE.key}):\n"
+    for hour in range(0, 24, 2):
+        count = hours[hour] + hours[hour + 1]
+        bar = "█" * round(count * 10 / (2 * peak)) if peak else ""
+        top_text += f"`{hour:02d}-{hour + 2:02d}` {bar} {count}\n"
+
+    top_text += f"\n📦 {len(analytics)} records in {format_bytes(analytics.memory_bytes())} of columns"
+    await message.reply_text(top_text)
+
+
+@app.on_message(filters.command("adminpopular") & filters.user(ADMIN_USER_IDS))
+async def admin_popular_command(client: Client, message: Message):
+    """Most requested videos (probes and downloads) from the heavy-hitters sketch"""
+    count = 10
+    if len(message.command) > 1 and message.command[1].isdigit():
+        count = max(1, min(int(message.command[1]), 50))
+
+    top = popular_videos.top(count)
+    if not top:
+        await message.reply_text("🔥 **No requests recorded yet**")
+        return
+
+    popular_text = (f"🔥 **MOST REQUESTED VIDEOS**\n"
+                    f"({popular_videos.updates} requests since start, "
+                    f"{len(popular_videos)}/{popular_videos.capacity} tracked)\n\n")
+    for i, (key, requests, error) in enumerate(top, 1):
+        title = (popular_videos.labels.get(key) or key)[:40]
+        accuracy = f" (±{error})" if error else ""
+        popular_text += f"{i}. **{title}**\n   {requests}{accuracy} requests | `{key}`\n"
+
+    await message.reply_text(popular_text)
+
+
 @app.on_message(filters.command("adminusers") & filters.user(ADMIN_USER_IDS))
 async def admin_users_command(client: Client, message: Message):
     """Show user list for admin"""
-    users_data = load_json_data(USERS_DATA_FILE, {})
-
-    if not users_data:
+    if not len(admin_stats.users_by_last_seen):
         await message.reply_text("👥 **No users found in database**")
         return
 
-    users_text = "👥 **USER LIST**\n\n"
+    users_text, markup = render_users_page()
+    await message.reply_text(users_text, reply_markup=markup)
 
-    # Sort users by last seen (most recent first)
-    sorted_users = sorted(users_data.items(),
-                          key=lambda x: x[1].get('last_seen', ''),
-                          reverse=True)
 
-    # Show first 20 users
-    for i, (user_id, user_info) in enumerate(sorted_users[:20], 1):
-        name = user_info.get('first_name', 'Unknown')
-        if user_info.get('last_name'):
-            name += f" {user_info.get('last_name')}"
+@app.on_message(filters.command("adminvideos") & filters.user(ADMIN_USER_IDS))
+async def admin_videos_command(client: Client, message: Message):
+    """Show recent video downloads for admin"""
+    if not len(admin_stats.videos_by_date):
+        await message.reply_text("🎥 **No videos found in database**")
+        return
 
-        username = user_info.get('username', 'No username')
-        downloads = user_info.get('total_downloads', 0)
-        last_seen = user_info.get('last_seen', '')[:10]  # Just date part
+    videos_text, markup = render_videos_page()
+    await message.reply_text(videos_text, reply_markup=markup)
 
-        users_text += f"{i}. **{name}** (@{username})\n"
-        users_text += f"   ID: `{user_id}` | Downloads: {downloads} | Last: {last_seen}\n\n"
 
-        # Telegram message length limit
-        if len(users_text) > 3500:
-            users_text += f"... and {len(sorted_users) - i} more users"
-            break
+@app.on_callback_query(filters.regex("^a[uv]_[no]_") & filters.user(ADMIN_USER_IDS))
+async def admin_page_callback(client: Client, callback_query: CallbackQuery):
+    """Move /adminusers and /adminvideos pages from the cursor in the button"""
+    prefix, direction, key, item_id = callback_query.data.split("_", 3)
+    older = direction == "o"
 
-    await message.reply_text(users_text)
+    if prefix == "au":
+        text, markup = render_users_page((key, item_id), older)
+    else:
+        text, markup = render_videos_page((key, int(item_id)), older)
 
+    await callback_query.edit_message_text(text, reply_markup=markup)
+    await callback_query.answer()
 
-@app.on_message(filters.command("adminvideos") & filters.user(ADMIN_USER_IDS))
-async def admin_videos_command(client: Client, message: Message):
-    """Show recent video downloads for admin"""
-    videos_data = load_json_data(VIDEOS_DATA_FILE, [])
 
-    if not videos_data:
-        await message.reply_text("🎥 **No videos found in database**")
+@app.on_message(filters.command("adminhistory") & filters.user(ADMIN_USER_IDS))
+async def admin_history_command(client: Client, message: Message):
+    """Show a user's full download history from the download log"""
+    if len(message.command) < 2:
+        await message.reply_text("❌ Usage: /adminhistory <user_id>")
         return
 
-    # Sort by download date (most recent first)
-    recent_videos = sorted(videos_data, key=lambda x: x.get(
-        'download_date', ''), reverse=True)
+    positions = admin_stats.videos_by_user.get(message.command[1], [])
+    if not positions:
+        await message.reply_text("🎥 **No downloads found for this user**")
+        return
 
-    videos_text = "🎥 **RECENT DOWNLOADS**\n\n"
+    history_text = f"🎥 **HISTORY OF {message.command[1]}** ({len(positions)} downloads)\n\n"
 
-    for i, video in enumerate(recent_videos[:15], 1):  # Show last 15 downloads
+    # Show last 20
+    for i, video in enumerate(download_log.read(reversed(positions[-20:])), 1):
         title = video.get('video_title', 'Unknown')[:40]
-        user_id = video.get('user_id', 'Unknown')
-        date = video.get('download_date', '')[:16]  # Date and time
-        format_info = video.get('format', 'Unknown')
-        file_size = video.get('file_size', 0)
-        size_mb = f"{file_size/1024/1024:.1f}MB" if file_size > 0 else "Unknown"
+        date = video.get('download_date', '')[:16]
+        status = "✅" if video.get('success', True) else "❌"
+        history_text += f"{i}. {status} **{title}**\n   {date} | {video.get('format', 'Unknown')}\n"
 
-        videos_text += f"{i}. **{title}**\n"
-        videos_text += f"   User: {user_id} | {date}\n"
-        videos_text += f"   Format: {format_info} | Size: {size_mb}\n\n"
+    if len(positions) > 20:
+        history_text += f"\n... and {len(positions) - 20} older downloads"
+
+    await message.reply_text(history_text)
+
+
+@app.on_message(filters.command("adminsearch") & filters.user(ADMIN_USER_IDS))
+async def admin_search_command(client: Client, message: Message):
+    """Find downloads whose title or URL contains all of the given terms"""
+    if len(message.command) < 2:
+        await message.reply_text("❌ Usage: /adminsearch <terms>")
+        return
 
-        # Telegram message length limit
-        if len(videos_text) > 3500:
-            videos_text += f"... and {len(recent_videos) - i} more videos"
-            break
+    query = " ".join(message.command[1:])
+    started = time.perf_counter()
+    positions = search_index.search(query)
+    elapsed = (time.perf_counter() - started) * 1000
+    if not positions:
+        await message.reply_text(f"🔍 **No downloads match** `{query}`")
+        return
+
+    search_text = f"🔍 **SEARCH:** `{query}` ({len(positions)} matches, {elapsed:.1f} ms)\n\n"
+
+    # Newest first
+    for i, video in enumerate(download_log.read(reversed(positions[-SEARCH_RESULTS:])), 1):
+        title = video.get('video_title', 'Unknown')[:40]
+        date = video.get('download_date', '')[:16]
+        status = "✅" if video.get('success', True) else "❌"
+        search_text += (f"{i}. {status} **{title}**\n"
+                        f"   👤 `{video.get('user_id', 'Unknown')}` | {date} | {video.get('format', 'Unknown')}\n")
 
-    await message.reply_text(videos_text)
+    if len(positions) > SEARCH_RESULTS:
+        search_text += f"\n... and {len(positions) - SEARCH_RESULTS} older matches"
+
+    search_text += f"\n\n📚 {len(search_index)} terms over {len(download_log)} records"
+    await message.reply_text(search_text)
 
 
 @app.on_message(filters.command("adminreset") & filters.user(ADMIN_USER_IDS))
 async def admin_reset_command(client: Client, message: Message):
     """Reset daily stats manually (admin only)"""
     # Force reset daily stats
-    current_date = str(datetime.now().date())
-    limits.bot_data['last_reset_date'] = current_date
-    limits.bot_data['total_downloads_today'] = 0
-    limits.bot_data['users_today'] = []
-    limits.bot_data['user_downloads_today'] = {}
-    limits.active_downloads.clear()
+    # Downloads in flight keep their slots; their leases free them
+    limits.log({'op': 'reset', 'date': str(current_stats_day()), 'clear_limits': True})
 
     # Save the reset data
-    save_json_data(BOT_DATA_FILE, limits.bot_data)
+    limits.schedule_save()
 
     await message.reply_text("🔄 **Daily stats have been reset manually!**\n\n"
                              "✅ All daily limits are now available again.")
 
 
+@app.on_message(filters.command("adminbenchprobe") & filters.user(ADMIN_USER_IDS))
+async def admin_bench_probe_command(client: Client, message: Message):
+    """Compare the fast probe against the full format-resolving probe"""
+    if len(message.command) < 2:
+        await message.reply_text("Usage: /adminbenchprobe <url>")
+        return
+
+    url = message.command[1]
+    loop = asyncio.get_event_loop()
+    ie_key = await loop.run_in_executor(probe_executor, site_index.match, url)
+
+    await message.reply_text("⏱️ Benchmarking probes... Please wait.")
+
+    timings = []
+    for name, probe in (('Fast probe', fast_probe), ('Full probe', full_probe)):
+        start = time.time()
+        try:
+            await loop.run_in_executor(probe_executor, probe, url, ie_key)
+            timings.append(f"• {name}: {time.time() - start:.2f}s")
+        except Exception as e:
+            timings.append(f"• {name}: failed after {time.time() - start:.2f}s ({e})")
+
+    await message.reply_text("⏱️ **PROBE BENCHMARK**\n\n"
+                             f"🔗 Extractor: {ie_key}\n" + "\n".join(timings))
+
+
+@app.on_message(filters.command("adminbenchwrites") & filters.user(ADMIN_USER_IDS))
+async def admin_bench_writes_command(client: Client, message: Message):
+    """Compare durable write throughput with and without group commit"""
+    writes = 200
+    if len(message.command) > 1 and message.command[1].isdigit():
+        writes = max(10, min(int(message.command[1]), 5000))
+
+    status_message = await message.reply_text(f"⏱️ Benchmarking {writes} concurrent durable writes...")
+    single_rate, single_p99 = await benchmark_commits(writes, group=False)
+    group_rate, group_p99 = await benchmark_commits(writes, group=True)
+
+    await status_message.edit_text(
+        f"⏱️ **Durable write benchmark** ({writes} concurrent writes)\n\n"
+        f"🐢 fsync per write: {single_rate:.0f} writes/s, p99 {single_p99 * 1000:.1f}ms\n"
+        f"🚀 Group commit ({GROUP_COMMIT_WINDOW * 1000:.0f}ms window): "
+        f"{group_rate:.0f} writes/s, p99 {group_p99 * 1000:.1f}ms"
+    )
+
+
+@app.on_message(filters.command("adminload") & filters.user(ADMIN_USER_IDS))
+async def admin_load_command(client: Client, message: Message):
+    """Show the admission controller's inputs and recent decisions"""
+    inputs = admission.inputs
+    if not inputs:
+        await message.reply_text("⏳ No load sample yet. Please try again shortly.")
+        return
+
+    load = f"{inputs['load_per_cpu']:.2f}" if inputs['load_per_cpu'] is not None else "n/a"
+    load_text = (
+        f"🖥️ **HOST LOAD**\n\n"
+        f"⚙️ Concurrent downloads: {inputs['active_downloads']}/{limits.max_concurrent_downloads} "
+        f"(bounds {MIN_CONCURRENT_DOWNLOADS}-{MAX_CONCURRENT_DOWNLOADS})\n"
+        f"• Load per CPU: {load}\n"
+        f"• Free disk: {format_bytes(inputs['free_disk_bytes'])}\n"
+        f"• Download speed: {format_speed(inputs['download_speed'])}\n"
+        f"• Upload speed: {format_speed(inputs['upload_speed'])}\n"
+        f"• Event loop lag: {inputs['loop_lag'] * 1000:.0f}ms\n"
+    )
+
+    if admission.decisions:
+        load_text += "\n📈 **Recent Decisions:**\n"
+        for decision in list(admission.decisions)[-5:]:
+            load_text += (f"• {decision['time'][:16]}: {decision['from']} → {decision['to']} "
+                          f"({decision['reason']})\n")
+
+    await message.reply_text(load_text)
+
+
 # Additional admin commands
 
 
@@ -478,10 +3140,20 @@ async def admin_help_command(client: Client, message: Message):
 • /adminstats - Detailed bot statistics
 • /adminusers - List all users
 • /adminvideos - Recent video downloads
+• /admintrend [days] - Daily trends from the rollups
+• /admintop [days] - Top users, formats and busy hours
+• /adminpopular [count] - Most requested videos
+• /adminhistory <user_id> - Full download history of a user
+• /adminsearch <terms> - Downloads whose title or URL has all terms
+• /adminbenchprobe <url> - Time the fast probe against the full one
+• /adminbenchwrites [writes] - Group commit against per-write fsync
 
 🛠️ **Management:**
+• /adminload - Host load and concurrency decisions
 • /adminreset - Reset daily limits manually
 • /adminbackup - Create data backup
+• /adminrestore [backup] - List backups or restore one
+• /adminimport <file> - Import a legacy videos_data.json
 • /admincleanup - Clean old temporary files
 
 ℹ️ **Info:**
@@ -494,42 +3166,161 @@ async def admin_help_command(client: Client, message: Message):
 
 @app.on_message(filters.command("adminbackup") & filters.user(ADMIN_USER_IDS))
 async def admin_backup_command(client: Client, message: Message):
-    """Create backup of all data files"""
+    """Create an incremental backup of all data files"""
     try:
-        backup_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_dir = f"backup_{backup_time}"
-        os.makedirs(backup_dir, exist_ok=True)
-
-        # Copy all data files to backup directory
-
-        files_backed_up = []
-        for filename in [USERS_DATA_FILE, VIDEOS_DATA_FILE, BOT_DATA_FILE]:
-            if os.path.exists(filename):
-                backup_path = os.path.join(backup_dir, filename)
-                shutil.copy2(filename, backup_path)
-                files_backed_up.append(filename)
-
-        # Create backup info file
-        backup_info = {
-            'backup_time': datetime.now().isoformat(),
-            'files_backed_up': files_backed_up,
-            'bot_stats': limits.get_stats()
-        }
-
-        with open(os.path.join(backup_dir, 'backup_info.json'), 'w') as f:
-            json.dump(backup_info, f, indent=2)
+        async with backup_lock:
+            snapshot = capture_snapshot()
+            loop = asyncio.get_running_loop()
+            backup_name, file_count, total_bytes, written_bytes = await loop.run_in_executor(
+                None, create_backup, snapshot, limits.get_stats())
 
         await message.reply_text(
             f"✅ **Backup created successfully!**\n\n"
-            f"📁 Backup directory: `{backup_dir}`\n"
-            f"📄 Files backed up: {len(files_backed_up)}\n"
-            f"🕐 Backup time: {backup_time}"
+            f"📁 Backup: `{backup_name}`\n"
+            f"🕐 Snapshot time: {snapshot['time'][:19]} (captured in {snapshot['capture_ms']:.1f}ms)\n"
+            f"📄 Files backed up: {file_count} ({format_bytes(total_bytes)})\n"
+            f"💾 New data stored: {format_bytes(written_bytes)} (compressed)"
         )
 
     except Exception as e:
         await message.reply_text(f"❌ Backup failed: {str(e)}")
 
 
+@app.on_message(filters.command("adminrestore") & filters.user(ADMIN_USER_IDS))
+async def admin_restore_command(client: Client, message: Message):
+    """Restore the data files from a backup"""
+    backups = list_backups()
+    if len(message.command) < 2:
+        if not backups:
+            await message.reply_text("📁 **No backups found**")
+            return
+        await message.reply_text(
+            "📁 **Available backups:**\n\n" +
+            "\n".join(f"• `{name}`" for name in reversed(backups)) +
+            "\n\nUse /adminrestore <backup> to restore one")
+        return
+
+    backup_name = message.command[1]
+    if backup_name not in backups:
+        await message.reply_text(f"❌ Backup `{backup_name}` not found")
+        return
+
+    global held_video_records, data_files_frozen
+    loop = asyncio.get_running_loop()
+    # No new reservations while the files are swapped; downloads that
+    # outlived their lease are held and written to the restored log
+    async with backup_lock, limits.lock:
+        if limits.active_downloads:
+            await message.reply_text("❌ Downloads are running, try again when they finish")
+            return
+
+        held_video_records = []
+        data_files_frozen = True
+        try:
+            # Let writes already under way land before the files are replaced
+            if limits.save_task:
+                await limits.save_task
+            persistence.drain()
+
+            # Keep the current state restorable too
+            safety_name, _, _, _ = await loop.run_in_executor(
+                None, create_backup, capture_snapshot(), limits.get_stats())
+            restored = await loop.run_in_executor(None, restore_backup, backup_name)
+
+            # Reload the in-memory state from the restored files; the WAL
+            # belongs to the state being replaced
+            limits.wal.truncate_through(limits.wal.seq)
+            limits.load_state()
+            user_store.__init__()
+            user_store.load()
+            download_log.load()
+            admin_stats.__init__()
+            admin_stats.rebuild()
+            analytics.load()
+            search_index.load()
+            popular_videos.load(load_json_data(POPULAR_VIDEOS_FILE, {}))
+            active_users.load()
+
+            await message.reply_text(
+                f"✅ **Restored `{backup_name}`**\n\n"
+                f"📄 Files restored: {len(restored)}\n"
+                f"💾 Previous state saved as `{safety_name}`"
+            )
+            logger.info(f"Restored backup {backup_name}")
+
+        except Exception as e:
+            # The log may have been replaced before the failure
+            download_log.load()
+            await message.reply_text(f"❌ Restore failed: {str(e)}")
+        finally:
+            data_files_frozen = False
+            limits.roll_over_day()  # In case the day ended during a failed restore
+            release_held_video_records()
+
+
+@app.on_message(filters.command("adminimport") & filters.user(ADMIN_USER_IDS))
+async def admin_import_command(client: Client, message: Message):
+    """Stream a legacy videos_data.json (e.g. from an old backup) into the download log"""
+    global admin_stats, analytics, search_index, held_video_records
+    if len(message.command) < 2:
+        await message.reply_text("❌ Usage: /adminimport <path to videos_data.json>")
+        return
+
+    path = message.command[1]
+    if not os.path.isfile(path):
+        await message.reply_text(f"❌ File `{path}` not found")
+        return
+
+    async with backup_lock:
+        status_message = await message.reply_text(f"📥 Importing `{path}`...")
+        loop = asyncio.get_running_loop()
+        last_report = [time.monotonic()]
+
+        def progress(rows, rate):
+            if time.monotonic() - last_report[0] >= 3:
+                last_report[0] = time.monotonic()
+                asyncio.run_coroutine_threadsafe(status_message.edit_text(
+                    f"📥 Importing `{path}`...\n\n📄 Rows: {rows}\n⚡ Speed: {rate:.0f} rows/s"), loop)
+
+        try:
+            rows, rate = await loop.run_in_executor(None, import_legacy_videos, path, progress)
+        except Exception as e:
+            logger.error(f"Importing {path} failed: {e}")
+            await status_message.edit_text(f"❌ Import failed: {str(e)}")
+            return
+
+        # Recompute the aggregates off the event loop, then swap them in.
+        # Downloads finishing meanwhile are held and stored after the swap,
+        # so the fresh aggregates see them exactly once
+        held_video_records = []
+        try:
+            fresh_stats = AdminStats()
+            fresh_columns = DownloadColumns()
+            fresh_search = SearchIndex()
+            await loop.run_in_executor(None, fresh_stats.rebuild_videos)
+            await loop.run_in_executor(None, fresh_columns.load)
+            await loop.run_in_executor(None, fresh_search.load)
+            fresh_stats.index_users()
+            fresh_stats.save()
+            admin_stats = fresh_stats
+            analytics = fresh_columns
+            search_index = fresh_search
+        except Exception as e:
+            logger.error(f"Rebuilding the statistics after importing {path} failed: {e}")
+            await status_message.edit_text(
+                f"⚠️ Imported {rows} rows, but rebuilding the statistics failed: {str(e)}")
+            return
+        finally:
+            release_held_video_records()
+
+    await status_message.edit_text(
+        f"✅ **Import complete!**\n\n"
+        f"📄 Rows imported: {rows}\n"
+        f"⚡ Speed: {rate:.0f} rows/s\n"
+        f"🎥 Download log: {len(download_log)} records"
+    )
+
+
 @app.on_message(filters.command("admincleanup") & filters.user(ADMIN_USER_IDS))
 async def admin_cleanup_command(client: Client, message: Message):
     """Clean up old temporary files and directories"""
@@ -550,7 +3341,7 @@ async def admin_cleanup_command(client: Client, message: Message):
                         except:
                             pass
 
-        # Clean up old backup directories (keep only last 5)
+        # Clean up old full-copy backup directories (keep only last 5)
         backup_dirs = [d for d in os.listdir('.') if d.startswith('backup_')]
         if len(backup_dirs) > 5:
             backup_dirs.sort()
@@ -561,6 +3352,10 @@ async def admin_cleanup_command(client: Client, message: Message):
                 except:
                     pass
 
+        # Keep only the last BACKUP_KEEP backups and the segments they use
+        async with backup_lock:
+            cleanup_count += await asyncio.get_running_loop().run_in_executor(None, prune_backups)
+
         await message.reply_text(
             f"✅ **Cleanup completed!**\n\n"
             f"🗑️ Files cleaned: {cleanup_count}\n"
@@ -595,7 +3390,7 @@ async def help_command(client: Client, message: Message):
 • Max 8 minutes video duration
 • Max 50MB file size
 
-🔄 **Limits reset daily at midnight UTC**
+🔄 **Limits refill gradually over a rolling 24 hours**
 
 💡 **Tips:**
 • Choose 360p for faster downloads
@@ -609,11 +3404,126 @@ async def help_command(client: Client, message: Message):
 progress_data = {}
 
 
-@app.on_message(filters.text & ~filters.command([]))
+# URLs in free text: anything with a scheme or "www.", or host/path pairs
+# such as "youtu.be/abc" that people paste without a scheme
+URL_PATTERN = re.compile(
+    r'(?:https?://|www\.)[^\s<>"]+|(?:[a-z0-9-]+\.)+[a-z]{2,}/[^\s<>"]*',
+    re.IGNORECASE)
+MAX_URLS_PER_MESSAGE = 5
+
+# Format options (limited for free plan)
+VIDEO_OPTIONS = [
+    ('480p', '🎥 480p quality'),
+    ('360p', '🎥 360p quality'),
+    ('worst', '🎥 Lowest quality (Fastest)')
+]
+
+# Height cap of each option and a fallback bitrate (bits/s) for estimates
+FORMAT_HEIGHTS = {'480p': 480, '360p': 360, 'worst': None}
+FORMAT_BITRATES = {'480p': 1_000_000, '360p': 600_000, 'worst': 250_000}
+
+
+def estimate_download_cost(video, format_code):
+    """Estimate bytes and media seconds a download will cost before it starts"""
+    duration = video.get('duration') or 0
+    max_height = FORMAT_HEIGHTS.get(format_code)
+    formats = video.get('formats') or []
+
+    # Mirror the "worst[height<=N]/worst" selectors over the probed formats
+    candidates = [f for f in formats if max_height is None or f[0] <= max_height] or formats
+    sizes = []
+    for height, size, tbr in candidates:
+        if size:
+            sizes.append(size)
+        elif tbr and duration:
+            sizes.append(tbr * 1000 / 8 * duration)
+
+    if sizes:
+        cost_bytes = min(sizes)
+    else:
+        cost_bytes = duration * FORMAT_BITRATES.get(format_code, FORMAT_BITRATES['480p']) / 8
+    return {'bytes': int(cost_bytes), 'seconds': int(duration)}
+
+
+def extract_urls(message):
+    """Collect the distinct URLs of a message, its caption and text links"""
+    text = message.text or message.caption or ''
+    urls = [url.rstrip('.,;:!?)]}\'"') for url in URL_PATTERN.findall(text)]
+
+    for entity in (message.entities or message.caption_entities or []):
+        if getattr(entity, 'url', None):
+            urls.append(entity.url)
+
+    unique_urls = []
+    for url in urls:
+        # Extractors expect a scheme ("youtu.be/..." is common in pasted links)
+        if '://' not in url:
+            url = f"https://{url}"
+        if url not in unique_urls:
+            unique_urls.append(url)
+    return unique_urls[:MAX_URLS_PER_MESSAGE]
+
+
+async def probe_url(url):
+    """Route, cache-check and probe one URL; returns video info or an error"""
+    # Route the URL to its extractor; known unsupported hosts fail right away
+    if site_index.known_unsupported(url):
+        return {'url': url, 'error': NegativeCache.MESSAGES['unsupported']}
+    loop = asyncio.get_event_loop()
+    ie_key = await loop.run_in_executor(probe_executor, site_index.match, url)
+
+    # Answer straight from the cache if this video failed recently
+    cache_key = canonical_url(url, ie_key)
+    cached_error = negative_cache.get(cache_key)
+    if cached_error:
+        return {'url': url, 'error': cached_error['message']}
+
+    try:
+        info_dict = await loop.run_in_executor(probe_executor, fast_probe, url, ie_key)
+    except Exception as e:
+        logger.error(f"Error fetching video info: {e}")
+        failure = negative_cache.record_failure(cache_key, e)
+        if ie_key == 'Generic' and failure['error_class'] == 'unsupported':
+            site_index.mark_unsupported(url)
+        return {'url': url, 'error': failure['message']}
+    negative_cache.record_success(cache_key)
+
+    if info_dict.get('_type') in ('playlist', 'multi_video'):
+        return {
+            'title': info_dict.get('title') or 'Playlist',
+            'url': url,
+            'ie_key': ie_key,
+            'playlist': PlaylistCursor(info_dict.get('entries') or [])
+        }
+
+    title = info_dict.get('title') or 'Unknown'
+    duration = int(info_dict.get('duration') or 0)
+    record_popular(cache_key, title)
+
+    # Check video size constraints for Render free plan
+    if duration and duration > 380:  # 6 minutes max for free plan
+        return {'url': url, 'error': "❌ Video too long. Maximum 6 minutes allowed."}
+
+    # Progressive formats as (height, size, kbps), used for cost estimates
+    formats = [
+        (f.get('height') or 0, f.get('filesize') or f.get('filesize_approx'), f.get('tbr'))
+        for f in info_dict.get('formats') or []
+        if f.get('vcodec') != 'none' and f.get('acodec') != 'none'
+    ]
+
+    return {
+        'title': title,
+        'duration': duration,
+        'url': url,
+        'ie_key': ie_key,
+        'formats': formats
+    }
+
+
+@app.on_message((filters.text | filters.caption) & ~filters.command([]))
 async def handle_url(client: Client, message: Message):
     """Handle URL messages with strict limits"""
     user_id = message.from_user.id
-    url = message.text.strip()
 
     # Save user interaction
     user_info = {
@@ -629,72 +3539,113 @@ async def handle_url(client: Client, message: Message):
         await message.reply_text(limit_message)
         return
 
-    # # Validate URL (basic check)
-    # if not any(domain in url.lower() for domain in ['youtube.com', 'youtu.be', 'instagram.com', 'tiktok.com', 'facebook.com', 'twitter.com', 'x.com']):
-    #     await message.reply_text("❌ Please send a valid video URL from supported platforms (YouTube, Instagram, TikTok, Facebook, Twitter)")
-    #     return
-
-    # Store URL temporarily
-    user_data[user_id] = {
-        'video_url': url,
-        'timestamp': datetime.now()
-    }
+    urls = extract_urls(message)
+    if not urls:
+        await message.reply_text("❌ Please send a video URL.")
+        return
 
     try:
-        # Get video info (lightweight check)
-        await message.reply_text("🔍 Checking video... Please wait.")
-
-        # Lightweight video info extraction
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'skip_download': True
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
-            title = info_dict.get('title', 'Unknown')
-            duration = info_dict.get('duration', 0)
+        # Get video info (lightweight check), all URLs at once
+        if len(urls) == 1:
+            await message.reply_text("🔍 Checking video... Please wait.")
+        else:
+            await message.reply_text(f"🔍 Checking {len(urls)} videos... Please wait.")
+
+        results = await asyncio.gather(*(probe_url(url) for url in urls))
+        videos = [result for result in results
+                  if 'error' not in result and 'playlist' not in result]
+        failures = [result for result in results if 'error' in result]
+        playlists = [result for result in results if 'playlist' in result]
+
+        # Playlists get their own paginated picker; one per message
+        user_data.pop(user_id, None)  # Drop any older session
+        if playlists:
+            for extra in playlists[1:]:
+                failures.append({'url': extra['url'],
+                                 'error': "📃 Only one playlist per message."})
+            playlist = {
+                'title': playlists[0]['title'],
+                'cursor': playlists[0]['playlist'],
+                'page': 0,
+                'selected': {}
+            }
+            user_data[user_id] = {
+                'videos': [],
+                'playlist': playlist,
+                'timestamp': datetime.now()
+            }
+            text, reply_markup = await render_playlist_page(playlist)
+            await message.reply_text(text, reply_markup=reply_markup)
+            if not videos and not failures:
+                return
 
-            # Check video size constraints for Render free plan
-            if duration and duration > 380:  # 6 minutes max for free plan
-                await message.reply_text("❌ Video too long. Maximum 6 minutes allowed.")
+        if not videos:
+            if playlists:
+                await message.reply_text("⚠️ **Skipped:**\n\n" +
+                                         "\n".join(f"• {f['url'][:60]}\n  {f['error']}" for f in failures))
                 return
+            if len(failures) == 1:
+                await message.reply_text(failures[0]['error'])
+            else:
+                await message.reply_text("❌ None of these videos can be downloaded:\n\n" +
+                                         "\n".join(f"• {f['url'][:60]}\n  {f['error']}" for f in failures))
+            return
 
         # Store video info for later use
-        user_data[user_id]['video_info'] = {
-            'title': title,
-            'duration': duration,
-            'url': url
-        }
+        user_data.setdefault(user_id, {}).update({
+            'videos': videos,
+            'timestamp': datetime.now()
+        })
 
-        # Create format options (limited for free plan)
-        video_options = [
-            ('480p', '🎥 480p quality'),
-            ('360p', '🎥 360p quality'),
-            ('worst', '🎥 Lowest quality (Fastest)')
-        ]
+        remaining = limits.remaining_for(user_id)
+
+        if len(videos) == 1 and not failures:
+            video = videos[0]
+            keyboard = []
+            for code, desc in VIDEO_OPTIONS:
+                button = InlineKeyboardButton(
+                    desc, callback_data=f"download_{code}_0")
+                keyboard.append([button])
+
+            duration = video['duration']
+            duration_str = f"{duration // 60}:{duration % 60:02d}" if duration else "Unknown"
+
+            await message.reply_text(
+                f"🎵 **Video Found:**\n"
+                f"📺 {video['title'][:50]}...\n"
+                f"⏳ Duration: {duration_str}\n\n"
+                f"👤 **Your remaining:** {remaining} videos\n\n"
+                f"⚠️ Choose 360p for best performance",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+            return
 
+        # Several videos: one row of qualities per video plus "all" buttons
+        found_text = f"🎵 **{len(videos)} Videos Found:**\n\n"
         keyboard = []
-        for code, desc in video_options:
-            button = InlineKeyboardButton(
-                desc, callback_data=f"download_{code}")
-            keyboard.append([button])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        duration_str = f"{int(duration) // 60}:{int(duration) % 60:02d}" if duration else "Unknown"
-        stats = limits.get_stats()
+        for index, video in enumerate(videos):
+            duration = video['duration']
+            duration_str = f"{duration // 60}:{duration % 60:02d}" if duration else "Unknown"
+            found_text += f"{index + 1}. {video['title'][:40]} ({duration_str})\n"
+            keyboard.append([
+                InlineKeyboardButton(f"{index + 1}. {code}", callback_data=f"download_{code}_{index}")
+                for code, _ in VIDEO_OPTIONS
+            ])
+        keyboard.append([
+            InlineKeyboardButton(f"⬇️ All {code}", callback_data=f"download_{code}_all")
+            for code, _ in VIDEO_OPTIONS
+        ])
+
+        if failures:
+            found_text += "\n⚠️ **Skipped:**\n"
+            for failure in failures:
+                found_text += f"• {failure['url'][:60]}\n  {failure['error']}\n"
 
         await message.reply_text(
-            f"🎵 **Video Found:**\n"
-            f"📺 {title[:50]}...\n"
-            f"⏳ Duration: {duration_str}\n\n"
-            # f"📊 **Remaining today:** {stats['remaining_downloads']} downloads\n"
-            f"👤 **Your remaining:** {limits.max_videos_per_user - limits.bot_data['user_downloads_today'].get(str(user_id), 0)} videos\n\n"
+            found_text +
+            f"\n👤 **Your remaining:** {remaining} videos\n\n"
             f"⚠️ Choose 360p for best performance",
-            reply_markup=reply_markup
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
     except Exception as e:
@@ -784,7 +3735,7 @@ def format_eta(eta):
         return f"{hours}h {minutes}m"
 
 
-async def update_progress(callback_query, user_id, start_time):
+async def update_progress(status_message, user_id, start_time):
     """Async function to update progress messages"""
     last_message_update = 0
 
@@ -841,7 +3792,7 @@ async def update_progress(callback_query, user_id, start_time):
                     )
 
                 try:
-                    await callback_query.edit_message_text(progress_text)
+                    await status_message.edit_text(progress_text)
                     last_message_update = current_time
                 except Exception as e:
                     # Handle rate limiting or other Telegram errors
@@ -861,7 +3812,7 @@ async def update_progress(callback_query, user_id, start_time):
                 )
 
                 try:
-                    await callback_query.edit_message_text(progress_text)
+                    await status_message.edit_text(progress_text)
                 except:
                     pass
                 break
@@ -872,42 +3823,257 @@ async def update_progress(callback_query, user_id, start_time):
             logging.error(f"Progress update error: {e}")
             await asyncio.sleep(2)
 
-# Modified download_video function
+# Download job queue
+
+pending_jobs = {}     # user_id -> deque of jobs waiting for that user
+worker_tasks = set()  # Keeps running worker tasks referenced
+
+
+def enqueue_download(client, job):
+    """Queue a download job; each user's jobs run one after another"""
+    user_id = job['user_id']
+    if user_id in pending_jobs:
+        pending_jobs[user_id].append(job)
+        return
+
+    pending_jobs[user_id] = deque([job])
+    task = asyncio.create_task(download_worker(client, user_id))
+    worker_tasks.add(task)
+    task.add_done_callback(worker_tasks.discard)
+
+
+async def download_worker(client, user_id):
+    """Run a user's queued jobs until there are none left"""
+    jobs = pending_jobs[user_id]
+    while jobs:
+        job = jobs.popleft()
+        try:
+            succeeded = await run_download_job(client, job)
+        except Exception as e:
+            logger.error(f"Download job error: {e}")
+            succeeded = False
+        if job.get('playlist'):
+            await update_playlist_progress(job['playlist'], succeeded)
+    del pending_jobs[user_id]
 
 
 @app.on_callback_query(filters.regex("^download_"))
 async def download_video(client: Client, callback_query: CallbackQuery):
-    """Handle video download with real-time progress updates"""
+    """Queue the chosen video(s) for download"""
     await callback_query.answer()
 
     user_id = callback_query.from_user.id
-    format_code = callback_query.data.replace("download_", "")
-
-    # Double-check limits before starting download
-    can_download, limit_message = limits.can_user_download(user_id)
-    if not can_download:
-        await callback_query.edit_message_text(limit_message)
-        return
+    format_code, _, selection = callback_query.data.replace(
+        "download_", "").rpartition("_")
 
-    # Get stored URL and video info
+    # Get stored video info
     user_session = user_data.get(user_id, {})
-    url = user_session.get('video_url')
-    video_info = user_session.get('video_info', {})
+    videos = user_session.get('videos', [])
+
+    if selection == 'all':
+        selected = [video for video in videos if video]
+    elif selection.isdigit() and int(selection) < len(videos):
+        selected = [videos[int(selection)]] if videos[int(selection)] else []
+    else:
+        selected = []
 
-    if not url:
+    if not selected:
         await callback_query.edit_message_text("❌ No video URL found. Please send a URL first.")
         return
 
-    # Mark download as started
-    limits.start_download(user_id)
+    if len(videos) == 1:
+        # Single video: the keyboard message becomes the progress message
+        user_session['videos'] = []
+        enqueue_download(client, {
+            'user_id': user_id,
+            'from_user': callback_query.from_user,
+            'video': selected[0],
+            'format_code': format_code,
+            'status_message': callback_query.message
+        })
+        return
+
+    if selection == 'all':
+        user_session['videos'] = []
+        await callback_query.edit_message_text(
+            f"📥 **{len(selected)} downloads queued** ({format_code})")
+    else:
+        videos[int(selection)] = None  # Each item can only be queued once
+
+    for video in selected:
+        status_message = await client.send_message(
+            user_id,
+            f"🕐 **Queued:** {video['title'][:50]}...\n"
+            f"📏 **Quality:** {format_code}"
+        )
+        enqueue_download(client, {
+            'user_id': user_id,
+            'from_user': callback_query.from_user,
+            'video': video,
+            'format_code': format_code,
+            'status_message': status_message
+        })
+
+
+async def render_playlist_page(playlist):
+    """Build the text and selection keyboard for the playlist's current page"""
+    loop = asyncio.get_event_loop()
+    page = playlist['page']
+    entries, has_next = await loop.run_in_executor(
+        probe_executor, playlist['cursor'].fetch_page, page)
+
+    text = (f"📃 **Playlist:** {playlist['title'][:50]}\n"
+            f"📄 Page {page + 1}\n\n"
+            f"Tap videos to select them, then pick a quality.")
+
+    keyboard = []
+    for offset, entry in enumerate(entries):
+        index = page * PLAYLIST_PAGE_SIZE + offset
+        duration = entry['duration']
+        duration_str = f"{duration // 60}:{duration % 60:02d}" if duration else "?"
+        if duration > 380:
+            mark = "⛔"  # Too long for the free plan
+        elif index in playlist['selected']:
+            mark = "✅"
+        else:
+            mark = "⬜"
+        keyboard.append([InlineKeyboardButton(
+            f"{mark} {index + 1}. {entry['title'][:35]} ({duration_str})",
+            callback_data=f"pl_toggle_{index}")])
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"pl_page_{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"pl_page_{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    if playlist['selected']:
+        keyboard.append([
+            InlineKeyboardButton(f"⬇️ {len(playlist['selected'])} × {code}",
+                                 callback_data=f"pl_download_{code}")
+            for code, _ in VIDEO_OPTIONS
+        ])
+
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def update_playlist_progress(tracker, succeeded):
+    """Count a finished playlist job and refresh the playlist's summary"""
+    tracker['done' if succeeded else 'failed'] += 1
+    finished = tracker['done'] + tracker['failed']
+    percentage = finished / tracker['total'] * 100
+
+    text = (f"📃 **Playlist:** {tracker['title'][:50]}\n\n"
+            f"{create_progress_bar(percentage)}\n\n"
+            f"✅ Delivered: {tracker['done']}/{tracker['total']}\n"
+            f"❌ Failed: {tracker['failed']}")
+    if finished == tracker['total']:
+        text += "\n\n🎉 **Playlist finished!**"
+
+    try:
+        await tracker['message'].edit_text(text)
+    except Exception as e:
+        if "MESSAGE_NOT_MODIFIED" not in str(e):
+            logger.error(f"Playlist progress update error: {e}")
+
+
+@app.on_callback_query(filters.regex("^pl_"))
+async def playlist_callback(client: Client, callback_query: CallbackQuery):
+    """Select playlist entries, turn pages and queue the selection"""
+    user_id = callback_query.from_user.id
+    playlist = user_data.get(user_id, {}).get('playlist')
+    if not playlist:
+        await callback_query.answer()
+        await callback_query.edit_message_text("❌ No playlist found. Please send the URL again.")
+        return
+
+    action, _, argument = callback_query.data[len("pl_"):].partition("_")
+
+    if action == 'toggle':
+        index = int(argument)
+        entries = playlist['cursor'].seen
+        if index in playlist['selected']:
+            del playlist['selected'][index]
+        elif index < len(entries) and entries[index]['duration'] <= 380:
+            if len(playlist['selected']) >= MAX_PLAYLIST_SELECTION:
+                await callback_query.answer(
+                    f"Maximum {MAX_PLAYLIST_SELECTION} videos per playlist", show_alert=True)
+                return
+            playlist['selected'][index] = entries[index]
+
+    elif action == 'page':
+        playlist['page'] = max(0, int(argument))
+
+    elif action == 'download' and playlist['selected']:
+        await callback_query.answer()
+        format_code = argument
+        selected = [playlist['selected'][index] for index in sorted(playlist['selected'])]
+        del user_data[user_id]['playlist']
+
+        tracker = {
+            'title': playlist['title'],
+            'total': len(selected),
+            'done': 0,
+            'failed': 0,
+            'message': callback_query.message
+        }
+        await callback_query.edit_message_text(
+            f"📃 **Playlist:** {playlist['title'][:50]}\n\n"
+            f"📥 **{len(selected)} downloads queued** ({format_code})")
+
+        # The playlist's jobs run one after another and share a status message
+        status_message = await client.send_message(
+            user_id, f"🕐 **Queued:** {len(selected)} videos")
+        for entry in selected:
+            enqueue_download(client, {
+                'user_id': user_id,
+                'from_user': callback_query.from_user,
+                'video': entry,
+                'format_code': format_code,
+                'status_message': status_message,
+                'playlist': tracker
+            })
+        return
+
+    await callback_query.answer()
+    text, reply_markup = await render_playlist_page(playlist)
+    try:
+        await callback_query.edit_message_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        if "MESSAGE_NOT_MODIFIED" not in str(e):
+            logger.error(f"Playlist page update error: {e}")
+
+
+async def run_download_job(client, job):
+    """Download one queued video with real-time progress updates
+
+    Returns True once the video was delivered to the user.
+    """
+    user_id = job['user_id']
+    from_user = job['from_user']
+    video_info = job['video']
+    format_code = job['format_code']
+    status_message = job['status_message']
+    url = video_info['url']
+    ie_key = video_info.get('ie_key')
+
+    # Claim a download slot now that the job is about to start
+    estimate = estimate_download_cost(video_info, format_code)
+    lease, limit_message = await limits.reserve(user_id, estimate)
+    if not lease:
+        await status_message.edit_text(limit_message)
+        return False
 
     # Initialize progress data
     progress_data[user_id] = {'status': 'preparing'}
     start_time = time.time()
+    succeeded = False
 
     try:
         # Show initial message
-        await callback_query.edit_message_text(
+        await status_message.edit_text(
             f"🔄 **Preparing Download...**\n\n"
             f"📺 **Video:** {video_info.get('title', 'Unknown')[:50]}...\n"
             f"📏 **Quality:** {format_code}\n\n"
@@ -927,11 +4093,9 @@ async def download_video(client: Client, callback_query: CallbackQuery):
         downloads_dir = os.path.join("downloads", str(user_id))
         os.makedirs(downloads_dir, exist_ok=True)
 
-        # Get video info
-        with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
-            title = info_dict.get('title', 'video')
-            duration = info_dict.get('duration', 0)
+        # Video info comes from the probe; formats are resolved by the download
+        title = video_info.get('title') or 'video'
+        duration = video_info.get('duration') or 0
 
         # Create safe filename
         safe_title = "".join(c for c in title if c.isalnum()
@@ -973,13 +4137,13 @@ async def download_video(client: Client, callback_query: CallbackQuery):
 
         # Start progress updater task
         progress_task = asyncio.create_task(
-            update_progress(callback_query, user_id, start_time))
+            update_progress(status_message, user_id, start_time))
 
         # Start download in a thread to avoid blocking
         def download_in_thread():
             try:
                 with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
+                    ydl.extract_info(url, download=True, ie_key=ie_key)
                 return True
             except Exception as e:
                 logging.error(f"Download thread error: {e}")
@@ -1000,18 +4164,18 @@ async def download_video(client: Client, callback_query: CallbackQuery):
             del progress_data[user_id]
 
         if not download_success:
-            await callback_query.edit_message_text("❌ Download failed. Please try again.")
-            limits.complete_download(user_id, success=False)
-            return
+            await status_message.edit_text("❌ Download failed. Please try again.")
+            lease.release(success=False)
+            return False
 
         # Find downloaded file
         downloaded_files = glob.glob(os.path.join(
             downloads_dir, f"{safe_title}_{timestamp}.*"))
 
         if not downloaded_files:
-            await callback_query.edit_message_text("❌ Download completed but file not found.")
-            limits.complete_download(user_id, success=False)
-            return
+            await status_message.edit_text("❌ Download completed but file not found.")
+            lease.release(success=False)
+            return False
 
         filepath = downloaded_files[0]
 
@@ -1021,15 +4185,15 @@ async def download_video(client: Client, callback_query: CallbackQuery):
 
             # Check file size limit for free plan
             if file_size_mb > 50:
-                await callback_query.edit_message_text(
+                await status_message.edit_text(
                     f"❌ **File Too Large**\n\n"
                     f"📏 **File Size:** {file_size_mb:.1f}MB\n"
                     f"🚫 **Limit:** 50MB (Free Plan)\n\n"
                     f"💡 *Try selecting 'Lowest Quality' format*"
                 )
                 os.remove(filepath)
-                limits.complete_download(user_id, success=False)
-                return
+                lease.release(success=False)
+                return False
 
             # Show upload progress
             upload_text = (
@@ -1039,14 +4203,15 @@ async def download_video(client: Client, callback_query: CallbackQuery):
                 f"📂 **Format:** {format_code}\n\n"
                 f"⏳ *Please wait while we upload your video...*"
             )
-            await callback_query.edit_message_text(upload_text)
+            await status_message.edit_text(upload_text)
 
             # Upload video
             try:
                 duration_str = f"{duration // 60}:{duration % 60:02d}" if duration else "Unknown"
 
+                upload_start = time.time()
                 await client.send_video(
-                    chat_id=callback_query.from_user.id,
+                    chat_id=from_user.id,
                     video=filepath,
                     caption=f"🎥 **{title[:100]}**\n\n"
                             f"📏 **Size:** {file_size_mb:.1f}MB\n"
@@ -1054,6 +4219,7 @@ async def download_video(client: Client, callback_query: CallbackQuery):
                             f"📂 **Quality:** {format_code}\n\n"
                             f"✅ **Downloaded successfully!**"
                 )
+                admission.record_upload(file_size, time.time() - upload_start)
 
                 # Success - save video data
                 video_data = {
@@ -1062,39 +4228,43 @@ async def download_video(client: Client, callback_query: CallbackQuery):
                     'duration': duration,
                     'format': format_code,
                     'file_size': file_size,
-                    'success': True
+                    'success': True,
+                    'ie_key': ie_key
                 }
                 save_video_data(user_id, video_data)
                 save_user_data(user_id, {
-                    'first_name': callback_query.from_user.first_name,
-                    'last_name': callback_query.from_user.last_name,
-                    'username': callback_query.from_user.username
+                    'first_name': from_user.first_name,
+                    'last_name': from_user.last_name,
+                    'username': from_user.username
                 }, video_url=url)
 
                 # Complete download tracking
-                limits.complete_download(user_id, success=True)
+                lease.release(success=True, usage={
+                    'bytes': file_size,
+                    'seconds': int(duration),
+                    'format': format_code
+                })
+                succeeded = True
                 stats = limits.get_stats()
-                user_remaining = limits.max_videos_per_user - \
-                    limits.bot_data['user_downloads_today'].get(
-                        str(user_id), 0)
+                user_remaining = limits.remaining_for(user_id)
 
                 # Final success message
                 success_text = (
                     f"🎉 **Upload Complete!**\n\n"
                     f"✅ **Video sent successfully**\n\n"
-                    f"📊 **Your Remaining Downloads Today:** {user_remaining}\n"
-                    f"🔄 **Limits reset daily at midnight UTC**\n\n"
+                    f"📊 **Downloads Available Now:** {user_remaining}\n"
+                    f"🔄 **Limits refill gradually over a rolling 24 hours**\n\n"
                     f"💡 *Send another URL to download more videos!*"
                 )
-                await callback_query.edit_message_text(success_text)
+                await status_message.edit_text(success_text)
 
             except Exception as upload_error:
-                await callback_query.edit_message_text(
+                await status_message.edit_text(
                     f"❌ **Upload Failed**\n\n"
                     f"🚫 **Error:** {str(upload_error)}\n\n"
                     f"💡 *Try again with a smaller file or different quality*"
                 )
-                limits.complete_download(user_id, success=False)
+                lease.release(success=False)
 
                 # Save failed video data
                 video_data = {
@@ -1103,7 +4273,8 @@ async def download_video(client: Client, callback_query: CallbackQuery):
                     'duration': duration,
                     'format': format_code,
                     'file_size': file_size,
-                    'success': False
+                    'success': False,
+                    'ie_key': ie_key
                 }
                 save_video_data(user_id, video_data)
 
@@ -1113,25 +4284,46 @@ async def download_video(client: Client, callback_query: CallbackQuery):
             except:
                 pass
         else:
-            await callback_query.edit_message_text("❌ File not found after download.")
-            limits.complete_download(user_id, success=False)
+            await status_message.edit_text("❌ File not found after download.")
+            lease.release(success=False)
 
     except Exception as e:
         logger.error(f"Download error: {e}")
-        await callback_query.edit_message_text(
+        await status_message.edit_text(
             f"❌ **An Error Occurred**\n\n"
             f"🚫 **Error:** {str(e)}\n\n"
             f"💡 *Please try again with a different URL or quality*"
         )
-        limits.complete_download(user_id, success=False)
+        lease.release(success=False)
 
     finally:
-        # Clean up user data and progress data
-        if user_id in user_data:
-            del user_data[user_id]
+        # Never leak the slot, even if the job is cancelled
+        lease.release(success=False)
+
+        # Clean up progress data
         if user_id in progress_data:
             del progress_data[user_id]
 
+    return succeeded
+
+
+async def run_bot():
+    """Run the client together with the background tasks"""
+    async with app:
+        tasks = [
+            asyncio.create_task(admission.run()),
+            asyncio.create_task(daily_reset_scheduler()),
+            asyncio.create_task(user_flush_scheduler())
+        ]
+        await idle()
+        for task in tasks:
+            task.cancel()
+        user_store.flush()
+        active_users.flush()
+        persistence.save_json(POPULAR_VIDEOS_FILE, popular_videos.to_dict())
+        persistence.drain()
+        limits.checkpoint()
+
 
 def main():
     print("🚀 Starting Video Downloader Bot")
@@ -1139,16 +4331,28 @@ def main():
     os.makedirs("downloads", exist_ok=True)
 
     # Initialize data files if they don't exist
-    if not os.path.exists(USERS_DATA_FILE):
-        save_json_data(USERS_DATA_FILE, {})
-    if not os.path.exists(VIDEOS_DATA_FILE):
-        save_json_data(VIDEOS_DATA_FILE, [])
+    download_log.load()
+
+    # Move the legacy video list into the download log once
+    migrate_legacy_videos()
 
+    user_store.load()
     print("✅ Data files initialized")
+
+    admin_stats.load()
+    analytics.load()
+    search_index.load()
+    popular_videos.load(load_json_data(POPULAR_VIDEOS_FILE, {}))
+    active_users.load()
+    print("✅ Admin stats loaded")
+
+    # Build (or load) the supported site index before taking requests
+    site_index.load_or_build()
+    print("✅ Supported site index ready")
     print("✅ Bot starting...")
 
     try:
-        app.run()
+        app.run(run_bot())
     except KeyboardInterrupt:
         logger.info("Bot stopped gracefully")
     except Exception as e:
@@ -0,0 +1,178 @@
+"""Concurrency stress test for BotLimits.reserve and DownloadLease
+
+Run from the repository root with: python -m unittest tests.test_download_leases
+"""
+import os
+import sys
+import random
+import asyncio
+import importlib
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+bot = None
+_original_dir = None
+_scratch_dir = None
+
+USERS = 20
+RESERVATIONS_PER_USER = 5
+MAX_CONCURRENT = 3
+ESTIMATE = {'bytes': 1024, 'seconds': 10}
+
+
+def setUpModule():
+    """Import bot from a scratch directory; it reads and writes its data
+    files in the working directory, already at import time"""
+    global bot, _original_dir, _scratch_dir
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "test")
+    os.environ.setdefault("BOT_TOKEN", "1:test")
+    os.environ.setdefault("ADMIN_USER_IDS", "1")
+    _original_dir = os.getcwd()
+    _scratch_dir = tempfile.TemporaryDirectory(prefix="bot_test_")
+    os.chdir(_scratch_dir.name)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    bot = importlib.import_module("bot")
+
+
+def tearDownModule():
+    bot.persistence.drain()
+    os.chdir(_original_dir)
+    _scratch_dir.cleanup()
+
+
+def make_limits():
+    """A BotLimits whose daily limits are out of the way, so only slots matter"""
+    limits = bot.BotLimits()
+    limits.log({'op': 'reset', 'date': str(bot.current_stats_day()), 'clear_limits': True})
+    limits.max_concurrent_downloads = MAX_CONCURRENT
+    limits.max_users_per_day = USERS * 2
+    limits.max_videos_per_user = RESERVATIONS_PER_USER * 2
+    limits.max_total_daily_downloads = USERS * RESERVATIONS_PER_USER * 2
+    limits.max_bytes_per_user = limits.max_total_daily_bytes = 1024 ** 3
+    limits.max_seconds_per_user = limits.max_total_daily_seconds = 10 ** 6
+    limits.user_buckets = bot.TokenBucketLimiter.per_window(
+        limits.max_videos_per_user, bot.DAY_SECONDS)
+    limits.user_byte_buckets = bot.TokenBucketLimiter.per_window(
+        limits.max_bytes_per_user, bot.DAY_SECONDS)
+    limits.user_second_buckets = bot.TokenBucketLimiter.per_window(
+        limits.max_seconds_per_user, bot.DAY_SECONDS)
+    return limits
+
+
+class _FakeMessage:
+    async def reply_text(self, text, **kwargs):
+        pass
+
+
+class DownloadLeaseStressTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.limits = make_limits()
+        self.peak = 0
+        self.outcomes = {'success': 0, 'failure': 0}
+
+    def tearDown(self):
+        bot.persistence.drain()
+
+    def check_slots(self):
+        active = len(self.limits.active_downloads)
+        self.peak = max(self.peak, active)
+        self.assertLessEqual(active, MAX_CONCURRENT)
+        self.assertLessEqual(len(self.limits.in_flight_costs), MAX_CONCURRENT)
+
+    async def download(self, user_id, rng):
+        """One reservation that finishes, fails, is cancelled or outlives its lease"""
+        while True:
+            lease, _ = await self.limits.reserve(user_id, ESTIMATE, timeout=rng.uniform(0.02, 0.1))
+            if lease:
+                break
+            await asyncio.sleep(rng.uniform(0.001, 0.01))
+        self.check_slots()
+
+        outcome = rng.choice(['success', 'failure', 'cancel', 'timeout'])
+        job = asyncio.create_task(asyncio.sleep(
+            rng.uniform(0.12, 0.2) if outcome == 'timeout' else rng.uniform(0, 0.05)))
+        if outcome == 'cancel':
+            await asyncio.sleep(0)
+            job.cancel()
+        try:
+            await job
+            # A job that outlived its lease still reports how it went
+            success = outcome != 'failure'
+            if outcome == 'timeout':
+                self.assertTrue(lease.expired)
+                success = rng.random() < 0.5
+        except asyncio.CancelledError:
+            success = False
+        lease.release(success=success)
+        lease.release(success=success)  # Releasing twice is a no-op
+        self.outcomes['success' if success else 'failure'] += 1
+
+    async def user(self, user_id, seed):
+        rng = random.Random(seed)
+        for _ in range(RESERVATIONS_PER_USER):
+            await self.download(user_id, rng)
+
+    async def test_concurrent_reservations(self):
+        """20 users x 5 reservations never exceed the cap and charge every outcome"""
+        downloads_before = self.limits.bot_data['total_downloads_all_time']
+        await asyncio.gather(*(self.user(user_id, user_id) for user_id in range(1, USERS + 1)))
+
+        self.assertEqual(self.peak, MAX_CONCURRENT)
+        self.assertEqual(self.limits.active_downloads, set())
+        self.assertEqual(self.limits.in_flight_costs, {})
+        self.assertEqual(sum(self.outcomes.values()), USERS * RESERVATIONS_PER_USER)
+        self.assertEqual(self.limits.bot_data['total_downloads_all_time'] - downloads_before,
+                         self.outcomes['success'])
+        self.assertEqual(self.limits.bot_data['failures_today'], self.outcomes['failure'])
+
+    async def test_late_release_after_timeout(self):
+        """An expired lease frees its slot; its late success is charged without
+        touching the user's next slot"""
+        lease, _ = await self.limits.reserve(7, ESTIMATE, timeout=0.01)
+        await asyncio.sleep(0.05)
+        self.assertTrue(lease.expired)
+        self.assertNotIn(7, self.limits.active_downloads)
+
+        next_lease, _ = await self.limits.reserve(7, ESTIMATE)
+        self.assertIsNotNone(next_lease)
+        downloads_before = self.limits.bot_data['total_downloads_all_time']
+        lease.release(success=True)
+        self.assertEqual(self.limits.bot_data['total_downloads_all_time'], downloads_before + 1)
+        self.assertIn(7, self.limits.active_downloads)
+        self.assertEqual(self.limits.bot_data['bytes_today'], ESTIMATE['bytes'])
+
+        next_lease.release(success=False)
+        self.assertNotIn(7, self.limits.active_downloads)
+
+    async def test_admin_reset_keeps_live_slots(self):
+        """/adminreset clears the counters, not the slots of running downloads"""
+        leases = [(await self.limits.reserve(user_id, ESTIMATE))[0]
+                  for user_id in range(1, MAX_CONCURRENT + 1)]
+        self.assertTrue(all(leases))
+
+        original_limits, bot.limits = bot.limits, self.limits
+        try:
+            await bot.admin_reset_command(None, _FakeMessage())
+        finally:
+            bot.limits = original_limits
+
+        refused, message = await self.limits.reserve(MAX_CONCURRENT + 1, ESTIMATE)
+        self.assertIsNone(refused)
+        self.assertIn("Server busy", message)
+
+        leases[0].release(success=True)
+        lease, _ = await self.limits.reserve(MAX_CONCURRENT + 1, ESTIMATE)
+        self.assertIsNotNone(lease)
+        for lease in leases[1:] + [lease]:
+            lease.release(success=True)
+        self.assertEqual(self.limits.active_downloads, set())
+        self.assertEqual(self.limits.in_flight_costs, {})
+
+
+if __name__ == "__main__":
+    unittest.main()